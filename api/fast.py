@@ -1,51 +1,196 @@
-from fastapi import FastAPI
+import asyncio
+import hmac
+from contextlib import asynccontextmanager
+from typing import List
+
+import httpx
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 
-from player_profiling.data import get_data_with_cache
-from player_profiling.utils import find_closest_players, find_player_index
+from player_profiling.data import get_data_with_cache, compact_dtypes
+from player_profiling.utils import (PLAYER_COLUMNS, FILTER_COLUMNS, build_cluster_index, build_filter_index,
+                                    build_name_index, find_closest_players, find_player_index)
 from player_profiling.params import *
 from player_profiling.registry import load_model
-from player_profiling.scraping_utils import plot_metrics
-from player_profiling.plot_utils import player_radar_plot
+from player_profiling.storage import table_version
+from player_profiling.statistics_cache import get_statistics_with_cache_async
+from player_profiling.plot_utils import RADAR_COLUMNS, build_radar_matrix, player_radar_plot
 from pathlib import Path
 
-app = FastAPI()
+# Only the columns used by the endpoints are loaded
+SERVING_COLUMNS = list(dict.fromkeys(PLAYER_COLUMNS + ['long_name', 'label'] +
+                                     list(FILTER_COLUMNS.values()) + RADAR_COLUMNS))
 
-print("\nLoading data...")
-query = f"""
-        SELECT *
-        FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME}
-        ORDER BY idx
-    """
+# Artifacts of a snapshot, reported by /ready
+ARTIFACTS = ['data', 'tsne', 'model']
 
-data_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME}.csv")
+def data_versions():
+    '''
+    Versions of the players and tsne tables (see storage.table_version), the
+    caches are unversioned if the storage can't tell
+    '''
+    try:
+        return {'data': table_version(GCP_PROJECT, BQ_DATASET, BQ_TABLENAME),
+                'tsne': table_version(GCP_PROJECT, BQ_DATASET, BQ_TABLENAME_TSNE)}
+    except Exception as e:
+        print(f"❌ Data versions unavailable, using the unversioned caches: {e}")
+        return {'data': None, 'tsne': None}
 
-app.state.data = get_data_with_cache(gcp_project=GCP_PROJECT,
-                                     query=query,
-                                     cache_path=data_cache_path,
-                                     data_has_header=True
-)
-print("✅ data loaded \n")
-
-print("\nLoading tsne...")
-query = f"""
-        SELECT *
-        FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME_TSNE}
-        ORDER BY idx
-    """
-tsne_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME_TSNE}.csv")
-app.state.tsne = get_data_with_cache(gcp_project=GCP_PROJECT,
-                                     query=query,
-                                     cache_path=tsne_cache_path,
-                                     data_has_header=True
-)
-print("✅ tsne loaded \n")
+def load_data(version=None):
+    '''
+    Load the serving columns of the players table with compact dtypes
+    '''
+    print("\nLoading data...")
+    query = f"""
+            SELECT {', '.join(SERVING_COLUMNS)}
+            FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME}
+            ORDER BY idx
+        """
+
+    data_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME}_serving.{DATA_CACHE_FORMAT}")
+
+    data = get_data_with_cache(gcp_project=GCP_PROJECT,
+                               query=query,
+                               cache_path=data_cache_path,
+                               data_has_header=True,
+                               columns=SERVING_COLUMNS,
+                               version=version
+    )
+    compact_data = compact_dtypes(data, categorical_columns=list(FILTER_COLUMNS.values()))
+    print(f"✅ data loaded, {data.memory_usage(deep=True).sum() / 1e6:.1f} MB -> "
+          f"{compact_data.memory_usage(deep=True).sum() / 1e6:.1f} MB with compact dtypes \n")
+
+    return compact_data
+
+def load_tsne(version=None):
+    '''
+    Load the tsne table
+    '''
+    print("\nLoading tsne...")
+    query = f"""
+            SELECT *
+            FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME_TSNE}
+            ORDER BY idx
+        """
+    tsne_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME_TSNE}.{DATA_CACHE_FORMAT}")
+    tsne = get_data_with_cache(gcp_project=GCP_PROJECT,
+                               query=query,
+                               cache_path=tsne_cache_path,
+                               data_has_header=True,
+                               version=version
+    )
+    print("✅ tsne loaded \n")
+
+    return tsne
+
+def build_data_indexes(data):
+    '''
+    Build the indexes that only need the players table
+    '''
+    return build_filter_index(data), build_name_index(data), build_radar_matrix(data)
+
+async def load_snapshot(publish=None):
+    '''
+    Load data, tsne and model concurrently into a new snapshot (dict of the
+    artifacts and the indexes built on them), calling publish with the
+    snapshot so far each time an artifact is ready
+    '''
+    publish = publish or (lambda snapshot: None)
+
+    versions = await asyncio.to_thread(data_versions)
+    data_task = asyncio.create_task(asyncio.to_thread(load_data, versions['data']))
+    tsne_task = asyncio.create_task(asyncio.to_thread(load_tsne, versions['tsne']))
+    model_task = asyncio.create_task(asyncio.to_thread(load_model))
+
+    tasks = [data_task, tsne_task, model_task]
+    try:
+        # A new dict is published every time, a published snapshot is never modified
+        data = await data_task
+        filter_index, name_index, radar_matrix = await asyncio.to_thread(build_data_indexes, data)
+        snapshot = {'versions': versions, 'data': data, 'filter_index': filter_index,
+                    'name_index': name_index, 'radar_matrix': radar_matrix}
+        publish(snapshot)
+        print("✅ data indexes built \n")
+
+        tsne = await tsne_task
+        cluster_index = await asyncio.to_thread(build_cluster_index, data, tsne)
+        snapshot = {**snapshot, 'tsne': tsne, 'cluster_index': cluster_index}
+        publish(snapshot)
+        print("✅ cluster index built \n")
+
+        # load_model returns None when the registry has no Production model yet
+        model = await model_task
+        if model is None:
+            raise RuntimeError("No Production model in the registry, run fit() first")
+        snapshot = {**snapshot, 'model': model}
+        publish(snapshot)
+        print("✅ model loaded \n")
+    finally:
+        # On failure, don't leave the other loads running unobserved
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return snapshot
+
+def set_snapshot(app, snapshot):
+    app.state.snapshot = snapshot
+
+async def load_state(app):
+    '''
+    Startup load, exposing each artifact as soon as it is ready
+    '''
+    try:
+        await load_snapshot(lambda snapshot: set_snapshot(app, snapshot))
+    except Exception as e:
+        print(f"❌ Loading failed: {e}")
+        app.state.load_error = str(e)
+
+async def reload_state(app):
+    '''
+    Build a complete new snapshot in the background and swap it in at once:
+    requests keep being served by the current snapshot until then
+    '''
+    try:
+        snapshot = await load_snapshot()
+    except Exception as e:
+        print(f"❌ Reload failed, keeping the current snapshot: {e}")
+        app.state.load_error = str(e)
+        return
+
+    set_snapshot(app, snapshot)
+    app.state.load_error = None
+    print(f"✅ Reloaded, data versions {snapshot['versions']} \n")
+
+@asynccontextmanager
+async def lifespan(app):
+    '''
+    Start loading in the background so uvicorn binds its port right away
+    '''
+    app.state.snapshot = {}
+    app.state.load_error = None
+
+    # Pooled HTTP client shared by the scraping requests
+    app.state.http_client = httpx.AsyncClient(timeout=20,
+                                              follow_redirects=True,
+                                              limits=httpx.Limits(max_connections=20))
 
-print("\nLoading model...")
-app.state.model = load_model()
-print("✅ model loaded \n")
+    app.state.loading = asyncio.create_task(load_state(app))
+    yield
+    app.state.loading.cancel()
+    await app.state.http_client.aclose()
 
-print("")
+def require(*artifacts):
+    '''
+    Dependency answering 503 until the given artifacts are loaded
+    '''
+    def check():
+        missing = [artifact for artifact in artifacts if artifact not in app.state.snapshot]
+        if missing:
+            raise HTTPException(status_code=503, detail=f"Still loading: {', '.join(missing)}")
+    return Depends(check)
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -61,15 +206,61 @@ def root():
         'message': "API is running!"
     }
 
-@app.get("/players-suggestion")
+@app.get("/ready")
+def ready(response: Response):
+    '''
+    Endpoint to return whether data, tsne and model are loaded, 503 until they all are,
+    with the data versions served and whether a (re)load is running
+    '''
+
+    snapshot = app.state.snapshot
+    artifacts = {artifact: artifact in snapshot for artifact in ARTIFACTS}
+    if not all(artifacts.values()):
+        response.status_code = 503
+
+    return {
+        'ready': all(artifacts.values()),
+        'artifacts': artifacts,
+        'versions': snapshot.get('versions'),
+        'loading': not app.state.loading.done(),
+        'error': app.state.load_error
+    }
+
+@app.post("/admin/reload", status_code=202)
+async def admin_reload(x_admin_token: str = Header(None)):
+    '''
+    Endpoint to reload data, tsne and model in the background (e.g. after a fit),
+    the current snapshot is served until the new one is complete, 409 if a
+    load is already running.
+    Needs the X-Admin-Token header matching ADMIN_TOKEN, disabled if it is unset
+    '''
+
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN")
+    if not hmac.compare_digest((x_admin_token or '').encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+    if not app.state.loading.done():
+        raise HTTPException(status_code=409, detail="A load is already running")
+    app.state.loading = asyncio.create_task(reload_state(app))
+
+    return {
+        'reloading': True,
+        'versions': app.state.snapshot.get('versions')
+    }
+
+@app.get("/players-suggestion", dependencies=[require('data', 'tsne')])
 def get_players_suggestion(player_index = int, continent = None, experience = None,
                            wage_range = None, value_range= None, league_level = None):
     '''
     Endpoint to return suggested players
     '''
 
-    closest_players = find_closest_players(player_index, app.state.data, app.state.tsne,
-                                           continent, experience, wage_range, value_range, league_level)
+    snapshot = app.state.snapshot
+    closest_players = find_closest_players(player_index, snapshot['data'], snapshot['tsne'],
+                                           continent, experience, wage_range, value_range, league_level,
+                                           cluster_index=snapshot['cluster_index'],
+                                           filter_index=snapshot['filter_index'])
     closest_players = closest_players.fillna('No Information')
     closest_players = closest_players.to_dict(orient="records")
 
@@ -77,13 +268,14 @@ def get_players_suggestion(player_index = int, continent = None, experience = No
         'players': closest_players,
     }
 
-@app.get("/find_player_by_name")
+@app.get("/find_player_by_name", dependencies=[require('data')])
 def get_find_player_by_name(player_name: str):
     '''
     Endpoint to return players by name
     '''
 
-    players_indexes = find_player_index(player_name, app.state.data)
+    snapshot = app.state.snapshot
+    players_indexes = find_player_index(player_name, snapshot['data'], snapshot['name_index'])
     if type(players_indexes) == str:
         return {
             'players': {}
@@ -95,26 +287,38 @@ def get_find_player_by_name(player_name: str):
             'players': players_indexes,
         }
 
-@app.get("/statistics")
-def get_statistics_by_name(player_index: int):
+@app.get("/statistics", dependencies=[require('data')])
+async def get_statistics_by_name(player_index: int):
     '''
     Endpoint to return players statistics
     '''
 
-    statistics = plot_metrics(app.state.data, player_index)
+    statistics = await get_statistics_with_cache_async(app.state.snapshot['data'], player_index,
+                                                       app.state.http_client)
     statistics['aggregated_data'] = statistics['aggregated_data'].to_dict(orient="records")
 
     return {
         'statistics': statistics
     }
 
-@app.get("/data_radar_plot")
-def get_data_radar_plot(player1_index: int, player2_index: int):
+@app.get("/data_radar_plot", dependencies=[require('data')])
+def get_data_radar_plot(player1_index: int = None, player2_index: int = None,
+                        player_index: List[int] = Query(None)):
     '''
-    Endpoint to return data to do the radar plot
+    Endpoint to return data to do the radar plot of two players
+    (player1_index, player2_index) or of any number of players (player_index repeated)
     '''
 
-    radar_data = player_radar_plot(app.state.data, player1_index, player2_index)
+    player_indexes = [index for index in (player1_index, player2_index) if index is not None]
+    player_indexes += player_index or []
+    if not player_indexes:
+        raise HTTPException(status_code=422, detail="At least one player index is required")
+
+    snapshot = app.state.snapshot
+    try:
+        radar_data = player_radar_plot(snapshot['data'], player_indexes, snapshot['radar_matrix'])
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     radar_data['grouped_df'] = radar_data['grouped_df'].to_dict(orient="records")
 
     return {
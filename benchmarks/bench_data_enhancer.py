@@ -0,0 +1,49 @@
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from player_profiling.data_enhancer import (BUCKETS, bucketize, wage_range_calc, player_experience,
+                                            value_range_calc, league_level_bin)
+
+ROW_FUNCTIONS = {
+    'wage_range': wage_range_calc,
+    'experience': player_experience,
+    'value_range': value_range_calc,
+    'league_level_bin': league_level_bin,
+}
+
+
+def make_players(n_rows, seed=0):
+    '''
+    Random players table with the columns used by the buckets, including missing values
+    '''
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        'wage_eur': rng.integers(500, 400_000, n_rows).astype(float),
+        'age': rng.integers(16, 45, n_rows),
+        'value_eur': rng.integers(10_000, 200_000_000, n_rows).astype(float),
+        'league_level': rng.integers(1, 6, n_rows).astype(float),
+    })
+    for column in ['wage_eur', 'value_eur', 'league_level']:
+        data.loc[rng.random(n_rows) < 0.01, column] = np.nan
+    return data
+
+def bench_data_enhancer(n_rows=1_000_000):
+    print(f"\n⭐️ Benchmark: data_enhancer bucketing on {n_rows} rows")
+    data = make_players(n_rows)
+
+    for name, bucket in BUCKETS.items():
+        values = data[bucket['column']]
+        args = (values, bucket['edges'], bucket['labels'], bucket['missing'])
+
+        same = bool((values.apply(ROW_FUNCTIONS[name]).values == bucketize(*args).astype(object).values).all())
+        row_time = min(timeit.repeat(lambda: values.apply(ROW_FUNCTIONS[name]), number=1, repeat=3))
+        vectorized_time = min(timeit.repeat(lambda: bucketize(*args), number=1, repeat=3))
+
+        print(f"{name:<17} apply {row_time * 1000:9.1f} ms | vectorized {vectorized_time * 1000:7.1f} ms"
+              f" | x{row_time / vectorized_time:6.1f} | same result: {same}")
+
+
+if __name__ == '__main__':
+    bench_data_enhancer()
@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from player_profiling.data import RAW_TEXT_COLUMNS, RAW_NUMERIC_COLUMNS, raw_dtypes
+
+# Run in a fresh interpreter so that each loader gets its own peak RSS
+LOADER = '''
+import json, sys, time
+import pandas as pd
+from player_profiling.data import load_all_data, load_data_fifa23, peak_rss_mb
+
+start = time.perf_counter()
+if sys.argv[2] == "legacy":
+    data = load_all_data(sys.argv[1])
+    data = data[data["fifa_version"] == 23].drop_duplicates("long_name")
+else:
+    data = load_data_fifa23(sys.argv[1])
+elapsed = time.perf_counter() - start
+data.to_pickle(sys.argv[3])
+print(json.dumps({"seconds": elapsed, "peak_rss_mb": peak_rss_mb()}))
+'''
+
+
+def make_raw_csv(path, n_rows, n_unused_columns=40, seed=0):
+    '''
+    Random raw FIFA csv with several versions, repeated names and unused columns
+    '''
+    rng = np.random.default_rng(seed)
+    n_names = n_rows // 6
+    data = {}
+    for column in RAW_TEXT_COLUMNS:
+        data[column] = rng.integers(0, n_names, n_rows).astype(str).astype(object) + f'_{column}'
+    data['long_name'] = 'player_' + rng.integers(0, n_names, n_rows).astype(str).astype(object)
+    data['preferred_foot'] = rng.choice(['Right', 'Left'], n_rows)
+    data['work_rate'] = rng.choice(['High/Low', 'Medium/Medium', 'Low/High'], n_rows)
+    for column in RAW_NUMERIC_COLUMNS:
+        data[column] = rng.integers(1, 100, n_rows)
+    data['fifa_version'] = rng.integers(15, 24, n_rows)
+    for column, dtype in raw_dtypes().items():
+        if dtype == 'float32':
+            data[column] = rng.integers(10, 99, n_rows).astype(float)
+            data[column][rng.random(n_rows) < 0.1] = np.nan
+    for i in range(n_unused_columns):
+        data[f'unused_{i}'] = rng.random(n_rows)
+    pd.DataFrame(data).to_csv(path, index=False)
+
+def run_loader(csv_path, mode, result_path):
+    output = subprocess.run([sys.executable, '-c', LOADER, csv_path, mode, result_path],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def bench_data_loading(n_rows=600_000):
+    print(f"\n⭐️ Benchmark: raw FIFA csv loading on {n_rows} rows")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'male_players.csv')
+        make_raw_csv(csv_path, n_rows)
+
+        results = {}
+        for mode in ['legacy', 'streaming']:
+            stats = run_loader(csv_path, mode, os.path.join(tmp_dir, f'{mode}.pickle'))
+            results[mode] = pd.read_pickle(os.path.join(tmp_dir, f'{mode}.pickle'))
+            print(f"{mode:<10} {stats['seconds']:6.2f} s | {n_rows / stats['seconds']:10,.0f} rows/s"
+                  f" | peak RSS {stats['peak_rss_mb']:7.0f} MB")
+
+    legacy, streaming = results['legacy'], results['streaming']
+    same = (legacy.index.equals(streaming.index) and
+            np.allclose(legacy[streaming.columns].select_dtypes('number').to_numpy(dtype=float),
+                        streaming.select_dtypes('number').to_numpy(dtype=float), equal_nan=True) and
+            (legacy['long_name'].to_numpy() == streaming['long_name'].to_numpy()).all())
+    print(f"same players: {same}")
+
+
+if __name__ == '__main__':
+    bench_data_loading()
@@ -0,0 +1,68 @@
+import timeit
+
+import numpy as np
+import pandas as pd
+from sklearn.impute import SimpleImputer
+
+from player_profiling.preprocessor import CHARACTERISTICS, scale_row, filter_data, impute_mean
+
+
+def make_players(n_rows, seed=0):
+    '''
+    Random FIFA-like players table with the columns used by filter_data
+    '''
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({column: rng.integers(10, 99, n_rows).astype(float) for column in CHARACTERISTICS})
+    for column in ['pace', 'shooting', 'passing', 'dribbling', 'defending', 'physic', 'goalkeeping_speed']:
+        data.loc[rng.random(n_rows) < 0.1, column] = np.nan
+    data['preferred_foot'] = rng.choice(['Right', 'Left'], n_rows)
+    data['work_rate'] = rng.choice(['High/High', 'High/Medium', 'Medium/Low', 'Low/High'], n_rows)
+    for column in ['age', 'height_cm', 'weight_kg', 'weak_foot', 'skill_moves']:
+        data[column] = rng.integers(1, 200, n_rows)
+    data['league_level'] = rng.choice([1, 2, 3, np.nan], n_rows)
+    return data
+
+def scale_rowwise(df):
+    '''
+    Previous scaling of filter_data, one scale_row call per player
+    '''
+    characteristics = df[CHARACTERISTICS].fillna({'goalkeeping_speed': 0})
+    return characteristics.apply(scale_row, axis=1)
+
+def impute_columnwise(df):
+    '''
+    Previous imputation of preprocess, one SimpleImputer fit per column
+    '''
+    df = df.copy()
+    imputer = SimpleImputer(strategy="mean")
+    for c in df.columns:
+        imputer.fit(df[[c]])
+        df[c] = imputer.transform(df[[c]])
+    return df
+
+def bench_preprocessor(n_rows=180_000):
+    print(f"\n⭐️ Benchmark: preprocessor on {n_rows} rows")
+    data = make_players(n_rows)
+    filtered = filter_data(data)
+
+    scaled = filtered[CHARACTERISTICS]
+    same = np.allclose(scale_rowwise(data)[CHARACTERISTICS], scaled, equal_nan=True)
+    old_time = min(timeit.repeat(lambda: scale_rowwise(data), number=1, repeat=1))
+    new_time = min(timeit.repeat(lambda: filter_data(data), number=1, repeat=3))
+    print(f"{'scaling':<10} apply {old_time * 1000:9.1f} ms | filter_data {new_time * 1000:7.1f} ms"
+          f" | x{old_time / new_time:6.1f} | same result: {same}")
+
+    # A players table written by a previous fit already holds preferred_foot as 1/0
+    fitted = data.assign(preferred_foot=data['preferred_foot'].map({'Right': 1, 'Left': 0}))
+    same = filter_data(fitted).equals(filtered)
+    print(f"{'refitting':<10} filter_data on a fitted table | same result: {same}")
+
+    same = np.allclose(impute_columnwise(filtered), impute_mean(filtered))
+    old_time = min(timeit.repeat(lambda: impute_columnwise(filtered), number=1, repeat=3))
+    new_time = min(timeit.repeat(lambda: impute_mean(filtered), number=1, repeat=3))
+    print(f"{'imputing':<10} loop  {old_time * 1000:9.1f} ms | impute_mean {new_time * 1000:7.1f} ms"
+          f" | x{old_time / new_time:6.1f} | same result: {same}")
+
+
+if __name__ == '__main__':
+    bench_preprocessor()
@@ -0,0 +1,38 @@
+import os
+import timeit
+
+from player_profiling.scraping_utils import (parse_search_page, parse_search_page_fast,
+                                             parse_player_page, parse_player_page_fast)
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_PATH, name), 'rb') as file:
+        return file.read()
+
+def bench(name, slow, fast, content, number):
+    '''
+    Time `slow` and `fast` on `content`, check they return the same result
+    '''
+    slow_result, fast_result = slow(content), fast(content)
+    same = slow_result == fast_result if isinstance(slow_result, str) else slow_result.equals(fast_result)
+
+    slow_time = min(timeit.repeat(lambda: slow(content), number=number, repeat=3)) / number
+    fast_time = min(timeit.repeat(lambda: fast(content), number=number, repeat=3)) / number
+
+    print(f"{name:<25} html.parser {slow_time * 1000:8.2f} ms | fast {fast_time * 1000:8.2f} ms"
+          f" | x{slow_time / fast_time:5.1f} | same result: {same}")
+
+def bench_scraping(number=20):
+    print("\n⭐️ Benchmark: Transfermarkt parsing on stored fixtures")
+    bench('search page', parse_search_page, parse_search_page_fast,
+          load_fixture('transfermarkt_search.html'), number)
+    bench('player page', parse_player_page, parse_player_page_fast,
+          load_fixture('transfermarkt_player.html'), number)
+    bench('goalkeeper page', parse_player_page, parse_player_page_fast,
+          load_fixture('transfermarkt_goalkeeper.html'), number)
+
+
+if __name__ == '__main__':
+    bench_scraping()
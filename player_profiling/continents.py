@@ -0,0 +1,49 @@
+# Offline nationality -> continent table for the FIFA `nationality_name` values,
+# continents named like the restcountries.com `region` field
+CONTINENTS = {
+    'Africa': [
+        'Algeria', 'Angola', 'Benin', 'Botswana', 'Burkina Faso', 'Burundi', 'Cameroon',
+        'Cape Verde Islands', 'Central African Republic', 'Chad', 'Comoros', 'Congo', 'Congo DR',
+        "Côte d'Ivoire", 'Djibouti', 'Egypt', 'Equatorial Guinea', 'Eritrea', 'Eswatini', 'Ethiopia',
+        'Gabon', 'Gambia', 'Ghana', 'Guinea', 'Guinea-Bissau', 'Kenya', 'Lesotho', 'Liberia', 'Libya',
+        'Madagascar', 'Malawi', 'Mali', 'Mauritania', 'Mauritius', 'Morocco', 'Mozambique', 'Namibia',
+        'Niger', 'Nigeria', 'Rwanda', 'São Tomé e Príncipe', 'Senegal', 'Seychelles', 'Sierra Leone',
+        'Somalia', 'South Africa', 'South Sudan', 'Sudan', 'Tanzania', 'Togo', 'Tunisia', 'Uganda',
+        'Zambia', 'Zimbabwe',
+    ],
+    'Americas': [
+        'Antigua and Barbuda', 'Argentina', 'Aruba', 'Bahamas', 'Barbados', 'Belize', 'Bermuda',
+        'Bolivia', 'Brazil', 'Canada', 'Cayman Islands', 'Chile', 'Colombia', 'Costa Rica', 'Cuba',
+        'Curacao', 'Dominica', 'Dominican Republic', 'Ecuador', 'El Salvador', 'French Guiana',
+        'Grenada', 'Guadeloupe', 'Guatemala', 'Guyana', 'Haiti', 'Honduras', 'Jamaica', 'Martinique',
+        'Mexico', 'Montserrat', 'Nicaragua', 'Panama', 'Paraguay', 'Peru', 'Puerto Rico',
+        'Saint Kitts and Nevis', 'Saint Lucia', 'Saint Vincent and the Grenadines', 'Suriname',
+        'Trinidad and Tobago', 'United States', 'Uruguay', 'Venezuela',
+    ],
+    'Asia': [
+        'Afghanistan', 'Armenia', 'Azerbaijan', 'Bahrain', 'Bangladesh', 'Cambodia', 'China PR',
+        'Chinese Taipei', 'Georgia', 'Hong Kong', 'India', 'Indonesia', 'Iran', 'Iraq', 'Israel',
+        'Japan', 'Jordan', 'Kazakhstan', 'Korea DPR', 'Korea Republic', 'Kuwait', 'Kyrgyzstan',
+        'Laos', 'Lebanon', 'Malaysia', 'Myanmar', 'Nepal', 'Oman', 'Pakistan', 'Palestine',
+        'Philippines', 'Qatar', 'Saudi Arabia', 'Singapore', 'Sri Lanka', 'Syria', 'Tajikistan',
+        'Thailand', 'Turkey', 'Turkmenistan', 'United Arab Emirates', 'Uzbekistan', 'Vietnam',
+        'Yemen',
+    ],
+    'Europe': [
+        'Albania', 'Andorra', 'Austria', 'Belarus', 'Belgium', 'Bosnia and Herzegovina', 'Bulgaria',
+        'Croatia', 'Cyprus', 'Czech Republic', 'Denmark', 'England', 'Estonia', 'Faroe Islands',
+        'Finland', 'France', 'Germany', 'Gibraltar', 'Greece', 'Hungary', 'Iceland', 'Italy',
+        'Kosovo', 'Latvia', 'Liechtenstein', 'Lithuania', 'Luxembourg', 'Malta', 'Moldova',
+        'Montenegro', 'Netherlands', 'North Macedonia', 'Northern Ireland', 'Norway', 'Poland',
+        'Portugal', 'Republic of Ireland', 'Romania', 'Russia', 'San Marino', 'Scotland', 'Serbia',
+        'Slovakia', 'Slovenia', 'Spain', 'Sweden', 'Switzerland', 'Ukraine', 'Wales',
+    ],
+    'Oceania': [
+        'Australia', 'Fiji', 'New Caledonia', 'New Zealand', 'Papua New Guinea', 'Samoa',
+        'Solomon Islands', 'Tahiti', 'Tonga', 'Vanuatu',
+    ],
+}
+
+NATIONALITY_CONTINENTS = {nationality: continent
+                          for continent, nationalities in CONTINENTS.items()
+                          for nationality in nationalities}
@@ -1,19 +1,76 @@
 import pandas as pd
 from pathlib import Path
-from google.cloud import bigquery
 from player_profiling.params import *
-from player_profiling.preprocessor import filter_data, preprocess, preprocess_tsne
-from player_profiling.data_enhancer import data_enhancer
+from player_profiling.storage import query_table, write_table, delete_rows
 import os
 import json
+import sys
+import time
 
-def load_all_data():
+# Columns of the raw FIFA csv read by load_data_fifa23 (the only ones used
+# downstream) and their dtypes, the skills are added by raw_dtypes
+RAW_TEXT_COLUMNS = ['short_name', 'long_name', 'player_url', 'player_positions', 'league_name', 'club_name',
+                    'nationality_name', 'preferred_foot', 'work_rate', 'player_face_url']
+RAW_NUMERIC_COLUMNS = {
+    'fifa_version': 'int8',
+    'overall': 'int8',
+    'age': 'int16',
+    'height_cm': 'int16',
+    'weight_kg': 'int16',
+    'weak_foot': 'int8',
+    'skill_moves': 'int8',
+    'league_level': 'float32',
+    'wage_eur': 'float64',
+    'value_eur': 'float64',
+}
+
+def raw_filename():
     '''
-    Function to return all players data
+    Function to return the path of the raw FIFA csv
     '''
 
     root_path = os.path.dirname(os.path.dirname(__file__))
-    filename = os.path.join(root_path, 'raw_data', 'male_players_23.csv')
+    return os.path.join(root_path, 'raw_data', 'male_players_23.csv')
+
+def raw_dtypes():
+    '''
+    Function to return the dtypes of the raw columns read by load_data_fifa23,
+    the skills (possibly missing) are read as float32
+    '''
+    from player_profiling.preprocessor import CHARACTERISTICS
+    from player_profiling.plot_utils import RADAR_COLUMNS
+
+    dtypes = {column: str for column in RAW_TEXT_COLUMNS}
+    dtypes.update(RAW_NUMERIC_COLUMNS)
+    for column in CHARACTERISTICS + RADAR_COLUMNS:
+        dtypes.setdefault(column, 'float32')
+
+    return dtypes
+
+def peak_rss_mb():
+    '''
+    Function to return the peak resident memory of the process in MB
+    '''
+    # VmHWM is the peak of the running program, ru_maxrss keeps the peak of
+    # the parent process it was forked from
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def load_all_data(filename = None):
+    '''
+    Function to return all players data
+    '''
+
+    filename = filename or raw_filename()
     chunksize = 100000
 
     chunks = pd.read_csv(filename, chunksize=chunksize, iterator=True, low_memory=False)
@@ -21,16 +78,39 @@ def load_all_data():
 #   df =pd.read_csv(filename, nrows= 10000) <- for quick calculations
     return df
 
-def load_data_fifa23():
+def load_data_fifa23(filename = None, fifa_version = 23, chunksize = 100000, dtypes = None):
     '''
     Function to return the unique players from Fifa 23
     The most updated version of each player
+    The csv is streamed by chunks, reading only the columns of dtypes (raw_dtypes
+    by default): each chunk is filtered on fifa_version and de-duplicated on
+    long_name (first row kept, as drop_duplicates on the whole file) before the
+    next one is read, so the memory is bounded by one chunk and the result
     '''
 
-    data = load_all_data()
-    data_fifa23 = data[data['fifa_version'] == 23]
+    filename = filename or raw_filename()
+    dtypes = dtypes or raw_dtypes()
+
+    start = time.perf_counter()
+    n_rows = 0
+    seen_names = set()
+    chunks = []
+
+    reader = pd.read_csv(filename, usecols=list(dtypes), dtype=dtypes, chunksize=chunksize)
+    for chunk in reader:
+        n_rows += chunk.shape[0]
 
-    data_fifa23 = data_fifa23.drop_duplicates('long_name')
+        chunk = chunk[chunk['fifa_version'] == fifa_version].drop_duplicates('long_name')
+        chunk = chunk[~chunk['long_name'].isin(seen_names)]
+        seen_names.update(chunk['long_name'])
+
+        chunks.append(chunk)
+
+    data_fifa23 = pd.concat(chunks)
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ {n_rows} rows streamed in {elapsed:.1f}s ({n_rows / elapsed:,.0f} rows/s), "
+          f"{data_fifa23.shape[0]} players kept, peak RSS {peak_rss_mb():.0f} MB")
 
     return data_fifa23
 
@@ -39,31 +119,103 @@ def get_data_with_cache(
         gcp_project:str,
         query:str,
         cache_path:Path,
-        data_has_header=True
+        data_has_header=True,
+        columns:list=None,
+        version:str=None
     ) -> pd.DataFrame:
     """
     Retrieve `query` data from BigQuery, or from `cache_path` if the file exists
     Store at `cache_path` if retrieved from BigQuery for future use
+    - a `.parquet` cache keeps the schema and is read memory-mapped; an existing
+      CSV cache with the same name is migrated to it on first use
+    - return only `columns` if given (only those are read from a Parquet cache)
+    - with a data `version` (see storage.table_version), the cache is
+      f"{stem}.{version}{suffix}": a new version of the table is fetched again
+      and the caches of the previous versions are removed once it is stored
+      (they stay available if the fetch fails); a legacy unversioned CSV cache
+      is never migrated (its version is unknown) and is removed the same way
+    - caches are written to a temporary file then moved in place, so that an
+      interrupted write never leaves a truncated cache behind
     """
 
+    cache_path = Path(cache_path)
+    base_path = cache_path
+    old_paths = []
+    if version is not None:
+        cache_path = base_path.with_name(f"{base_path.stem}.{version}{base_path.suffix}")
+        if not cache_path.is_file():
+            old_paths = list(base_path.parent.glob(f"{base_path.stem}.*{base_path.suffix}"))
+            old_paths.append(base_path.with_suffix(".csv"))
+
+    is_parquet = cache_path.suffix == ".parquet"
+
+    csv_cache_path = cache_path.with_suffix(".csv")
+    if version is None and is_parquet and not cache_path.is_file() and csv_cache_path.is_file():
+        print("\nMigrate local CSV cache to Parquet...")
+        df = pd.read_csv(csv_cache_path, header='infer' if data_has_header else None)
+        df.columns = df.columns.astype(str)
+        write_cache(df, cache_path, data_has_header)
+
     if cache_path.is_file():
-        print("\nLoad data from local CSV...")
-        df = pd.read_csv(cache_path, header='infer' if data_has_header else None)
+        if is_parquet:
+            print("\nLoad data from local Parquet...")
+            df = pd.read_parquet(cache_path, columns=columns, memory_map=True)
+        else:
+            print("\nLoad data from local CSV...")
+            df = pd.read_csv(cache_path, header='infer' if data_has_header else None, usecols=columns)
     else:
-        print("\nLoad data from BigQuery server...")
-        client = bigquery.Client(project=gcp_project)
-        query_job = client.query(query)
-        result = query_job.result()
-        df = result.to_dataframe()
+        print(f"\nLoad data from {'local DuckDB' if DATA_TARGET == 'duckdb' else 'BigQuery server'}...")
+        df = query_table(gcp_project, query)
 
-        # Store as CSV if the BQ query returned at least one valid line
+        # Store locally if the BQ query returned at least one valid line
         if df.shape[0] > 1:
-            df.to_csv(cache_path, header=data_has_header, index=False)
+            write_cache(df, cache_path, data_has_header)
+
+        if columns is not None:
+            df = df[columns]
+
+    if cache_path.is_file():
+        for old_path in old_paths:
+            if old_path != cache_path:
+                old_path.unlink(missing_ok=True)
 
     print(f"✅ Data loaded, with shape {df.shape}")
 
     return df
 
+def write_cache(df: pd.DataFrame, cache_path: Path, data_has_header=True) -> None:
+    """
+    Write `df` to `cache_path` (Parquet or CSV after its suffix) through a
+    temporary file replacing it atomically
+    """
+
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        if cache_path.suffix == ".parquet":
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_csv(tmp_path, header=data_has_header, index=False)
+        os.replace(tmp_path, cache_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def compact_dtypes(df: pd.DataFrame, categorical_columns: list = ()) -> pd.DataFrame:
+    """
+    Return a copy of `df` with `categorical_columns` as category and the
+    numeric columns downcast to the smallest integer type / float32
+    """
+
+    df = df.copy()
+    for column in df.columns:
+        if column in categorical_columns:
+            df[column] = df[column].astype("category")
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+        elif pd.api.types.is_float_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="float")
+
+    return df
+
 def load_data_to_bq(
         data: pd.DataFrame,
         gcp_project:str,
@@ -72,37 +224,51 @@ def load_data_to_bq(
         truncate: bool
     ):
     """
-    - Save the DataFrame to BigQuery
+    - Save the DataFrame to BigQuery (or to the local DuckDB tables, see storage.DATA_TARGET)
     - Empty the table beforehand if `truncate` is True, append otherwise
     """
 
     assert isinstance(data, pd.DataFrame)
     full_table_name = f"{gcp_project}.{bq_dataset}.{table}"
-    print(f"\nSave data to BigQuery @ {full_table_name}...:")
+    print(f"\nSave data to {DATA_TARGET} @ {full_table_name}...:")
 
     if table == BQ_TABLENAME_TSNE:
         data.columns = [f"_{column}" if not str(column)[0].isalpha() and not str(column)[0] == "_" else str(column) for column in data.columns]
 
-    client = bigquery.Client(project=gcp_project)
+    print(f"\n{'Write' if truncate else 'Append'} {full_table_name} ({data.shape[0]} rows)")
 
-    # Define write mode and schema
-    write_mode = "WRITE_TRUNCATE" if truncate else "WRITE_APPEND"
-    job_config = bigquery.LoadJobConfig(write_disposition=write_mode)
+    write_table(data, gcp_project=gcp_project, bq_dataset=bq_dataset, table=table, truncate=truncate)
 
-    print(f"\n{'Write' if truncate else 'Append'} {full_table_name} ({data.shape[0]} rows)")
+    print(f"✅ Data saved to {DATA_TARGET}, with shape {data.shape}")
+
+def delete_from_bq(
+        gcp_project:str,
+        bq_dataset:str,
+        table: str,
+        idx: list
+    ):
+    """
+    Delete the rows of `table` whose idx is in `idx`, so that updated rows can
+    be appended without rewriting the whole table
+    """
+
+    full_table_name = f"{gcp_project}.{bq_dataset}.{table}"
+    print(f"\nDelete {len(idx)} rows from {full_table_name}...")
 
-    # Load data
-    job = client.load_table_from_dataframe(data, full_table_name, job_config=job_config)
-    result = job.result()  # wait for the job to complete
+    deleted = delete_rows(gcp_project=gcp_project, bq_dataset=bq_dataset, table=table, idx=idx)
 
-    print(f"✅ Data saved to bigquery, with shape {data.shape}")
+    print(f"✅ {deleted} rows deleted")
 
 def create_bq_tables():
     '''
     Function to create Big Query Database
     '''
+    from player_profiling.preprocessor import filter_data, preprocess, preprocess_tsne
+    from player_profiling.data_enhancer import data_enhancer
+    from player_profiling.stage_cache import forget_uploads
 
     print(f"\nLoading data and creating bigquery table...:")
+    forget_uploads(BQ_TABLENAME, BQ_TABLENAME_TSNE)
     data = load_data_fifa23()
 
     # Create label column
@@ -1,27 +1,100 @@
+import numpy as np
 import pandas as pd
 import requests
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+from player_profiling.params import CONTINENT_CACHE_PATH
+from player_profiling.continents import NATIONALITY_CONTINENTS
 
-def find_continent(country):
+# Declarative buckets used by data_enhancer, the vectorized equivalent of
+# player_experience, league_level_bin, wage_range_calc and value_range_calc:
+# new column -> source column, upper edges (included) of all buckets but the
+# last one, labels from lowest to highest, label of missing values
+BUCKETS = {
+    'wage_range': {
+        'column': 'wage_eur',
+        'edges': [7000, 16000, 25000],
+        'labels': ['Low salary', 'Medium-low salary', 'Medium-high salary', 'High salary'],
+        'missing': 'Low salary',
+    },
+    'experience': {
+        'column': 'age',
+        'edges': [20, 25, 30, 35],
+        'labels': ['Prospect', 'Emerging Talent', 'Established Player', 'Peak Performance', 'Experienced Campaigner'],
+        'missing': 'Experienced Campaigner',
+    },
+    'value_range': {
+        'column': 'value_eur',
+        'edges': [7_000_000, 25_000_000, 50_000_000, 100_000_000],
+        'labels': ['Good deal', 'Affordable', 'Expensive', 'Really expensive', 'Crazily expensive'],
+        'missing': 'Good deal',
+    },
+    # league levels are integers starting at 1
+    'league_level_bin': {
+        'column': 'league_level',
+        'edges': [1],
+        'labels': ['1st', '2nd'],
+        'missing': '2nd',
+    },
+}
+
+
+def find_continent(country, timeout = 5):
+    '''
+    Looks up the region of a country on restcountries.com,
+    returns 'Other' if the country is unknown and None if the lookup failed
+    '''
     url = 'https://restcountries.com/v3.1/name/'
-    response = requests.get(url + country)
-    #time.sleep(2)
+    try:
+        response = requests.get(url + country, timeout=timeout)
+    except requests.RequestException:
+        return None
+
     if response.status_code == 200:
         return response.json()[0]['region']
-    else:
+    elif response.status_code == 404:
         return 'Other'
+    else:
+        return None
 
-def continent_dictionary(data):
+def continent_dictionary(data, cache_path = CONTINENT_CACHE_PATH, online = True, max_workers = 8, timeout = 5):
     '''
     Creates a dictionary of nations:continent
+    - from the bundled offline table first
+    - then from the persistent cache at cache_path
+    - then, if online, from concurrent restcountries.com lookups (stored in the cache)
+    Nations still unresolved are mapped to 'Other'
     '''
-    cont_dict = {}
-    count = 0
-    for c in data['nationality_name'].unique():
-        count += 1
-        print(f"iteration {count} / {len(data['nationality_name'].unique())}")
-        cont_dict[c]=find_continent(c)
+    nations = data['nationality_name'].dropna().unique()
+    cont_dict = {c: NATIONALITY_CONTINENTS[c] for c in nations if c in NATIONALITY_CONTINENTS}
+
+    cache = {}
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+    cont_dict.update({c: cache[c] for c in nations if c not in cont_dict and c in cache})
+
+    missing = [c for c in nations if c not in cont_dict]
+    if missing and online:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            found = dict(zip(missing, executor.map(lambda c: find_continent(c, timeout), missing)))
+        found = {c: continent for c, continent in found.items() if continent is not None}
+
+        if found:
+            cache.update(found)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(cache, file, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+        cont_dict.update(found)
+
+    unresolved = [c for c in nations if c not in cont_dict]
+    cont_dict.update({c: 'Other' for c in unresolved})
+
+    print(f"Continents resolved for {len(nations)} nations ({len(missing)} not in the offline table, "
+          f"{len(unresolved)} unresolved)")
     return cont_dict
 
 def player_experience (age):
@@ -62,6 +135,15 @@ def value_range_calc(value):
     else:
         return 'Good deal'
 
+def bucketize(values, edges, labels, missing):
+    '''
+    Returns the label of the bucket of every value as a categorical,
+    edges being the included upper bounds of all buckets but the last one
+    '''
+    bins = [-np.inf] + list(edges) + [np.inf]
+    buckets = pd.cut(pd.to_numeric(values), bins=bins, labels=labels, right=True)
+    return buckets.fillna(missing)
+
 def data_enhancer(data, cont_json = None):
     '''
     It adds some useful columns for filtering
@@ -72,9 +154,7 @@ def data_enhancer(data, cont_json = None):
         data['Continent']= data['nationality_name'].map(cont_dict)
     else:
         data['Continent']= data['nationality_name'].map(continent_dictionary(data))
-    data['wage_range']= data['wage_eur'].apply(wage_range_calc)
-    data['experience']= data['age'].apply(player_experience)
-    data['value_range'] = data['value_eur'].apply(value_range_calc)
-    data['league_level_bin'] = data['league_level'].apply(league_level_bin)
+    for name, bucket in BUCKETS.items():
+        data[name] = bucketize(data[bucket['column']], bucket['edges'], bucket['labels'], bucket['missing'])
 
     return data
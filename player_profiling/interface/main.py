@@ -1,20 +1,83 @@
+import copy
 from pathlib import Path
 import pandas as pd
 
 from player_profiling.params import *
-from player_profiling.preprocessor import filter_data, preprocess, preprocess_tsne
-from player_profiling.registry import load_model, save_model, mlflow_transition_model, mlflow_run
-from player_profiling.model import initialize_model_kmeans, initialize_model_spectral, fit_model
-from player_profiling.data import get_data_with_cache, load_data_to_bq
+from player_profiling.preprocessor import (fit_preprocessing_pipeline, transform_players, preprocess_tsne,
+                                          embed_new_players, interpolate_embedding)
+from player_profiling.registry import (load_model, save_model, mlflow_transition_model, local_transition_model, mlflow_run,
+                                      save_preprocessor, load_preprocessor, save_embedding, load_embedding, save_results)
+from player_profiling.model import (initialize_model_kmeans, initialize_model_spectral, initialize_model_minibatch,
+                                   warm_start_model, iter_batches, partial_fit_model, fit_model,
+                                   sweep_n_clusters)
+from player_profiling.data import get_data_with_cache, load_data_to_bq, delete_from_bq
+from player_profiling.storage import table_version
+from player_profiling.stage_cache import run_stage, hash_data, is_uploaded, mark_uploaded, forget_uploads
+
+def upload_table(data: pd.DataFrame, table: str) -> None:
+    """
+    Rewrite `table` with `data`, unless fit() already wrote this exact content
+    and nothing wrote the table since (its storage version did not change)
+    """
+
+    key = hash_data(data)
+    if is_uploaded(table, key, stored_table_version(table)):
+        print(f"✅ {table} unchanged, upload skipped")
+        return None
+
+    load_data_to_bq(data,
+        gcp_project=GCP_PROJECT,
+        bq_dataset=BQ_DATASET,
+        table=table,
+        truncate=True)
+    mark_uploaded(table, key, stored_table_version(table))
+
+def stored_table_version(table: str) -> str:
+    """
+    Return the storage version of `table`, None if it does not exist
+    """
+
+    try:
+        return table_version(GCP_PROJECT, BQ_DATASET, table)
+    except Exception:
+        return None
+
+
+def promote_model(model) -> None:
+    """
+    Save `model` and transition it to Production
+    """
+
+    save_model(model=model)
+
+    if MODEL_TARGET == 'mlflow':
+        mlflow_transition_model(current_stage="None", new_stage="Production")
+    elif MODEL_TARGET == 'local':
+        local_transition_model(current_stage="None", new_stage="Production")
+
+
+def clustering_matrix(tsne: pd.DataFrame):
+    """
+    Return the features the clustering models are fitted and predict on: the
+    tsne coordinates, without idx (same matrix for fit, sweep and embed_players)
+    """
+
+    return tsne.drop(columns=['idx']).to_numpy()
+
 
 @mlflow_run
-def fit(model_type = 'kmeans'):
+def fit(model_type = 'kmeans', batch_size = 4096, max_samples = None):
     """
     - Download data from BQ table (or from cache if it exists)
     - Preprocess data
-    - Fit model
+    - Fit model: 'kmeans', 'spectral' (on a sample of max_samples players if
+      given) or 'minibatch' (warm-started from the Production centroids and
+      fitted by batches of batch_size)
     """
 
+    if model_type not in ('kmeans', 'spectral', 'minibatch'):
+        raise ValueError(f"Unknown model_type {model_type!r}, expected 'kmeans', 'spectral' or 'minibatch'")
+
     print("\n⭐️ Use case: fit")
     print("\nLoading data...")
 
@@ -24,12 +87,13 @@ def fit(model_type = 'kmeans'):
         ORDER BY idx
     """
 
-    data_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME}.csv")
+    data_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME}.{DATA_CACHE_FORMAT}")
     data = get_data_with_cache(
         gcp_project=GCP_PROJECT,
         query=query,
         cache_path=data_cache_path,
-        data_has_header=True
+        data_has_header=True,
+        version=table_version(GCP_PROJECT, BQ_DATASET, BQ_TABLENAME)
     )
 
     data_continent = data['Continent']
@@ -38,45 +102,59 @@ def fit(model_type = 'kmeans'):
     data_value_range = data['value_range']
     data_league_level_bin = data['league_level_bin']
 
-    data = data.drop(columns=['idx', 'Continent', 'experience', 'wage_range', 'value_range', 'league_level_bin'])
+    # label is an output of fit, it must not change the stage cache keys
+    data = data.drop(columns=['idx', 'label', 'Continent', 'experience', 'wage_range', 'value_range', 'league_level_bin'],
+                     errors='ignore')
     if data.shape[0] < 10:
         print("❌ Not enough processed data retrieved to fit")
         return None
 
-    print("\nFiltering features...")
-    data_filtered = filter_data(data)
-    print("\nPreprocessing data...")
-    data_preproc = preprocess(data_filtered)
+    # Stages are skipped when they already ran on the same data with the same params
+    print("\nFitting preprocessing pipeline...")
+    preprocessor, data_preproc = run_stage('preprocess', fit_preprocessing_pipeline, data)
+    save_preprocessor(preprocessor)
     print("\nPreprocessing data tsne...")
-    data_preproc_tsne = pd.DataFrame(preprocess_tsne(data_preproc))
+    embedding, reducer = run_stage('embedding', preprocess_tsne, data_preproc,
+                                   backend=EMBEDDING_BACKEND, return_reducer=True)
+    save_embedding(reducer)
+    data_preproc_tsne = pd.DataFrame(embedding)
+    data_preproc_tsne.columns = [f"_{column}" for column in data_preproc_tsne.columns]
 
     data_preproc_tsne['idx'] = data_preproc_tsne.index
 
-    load_data_to_bq(data_preproc_tsne,
-        gcp_project=GCP_PROJECT,
-        bq_dataset=BQ_DATASET,
-        table=BQ_TABLENAME_TSNE,
-        truncate=True)
+    upload_table(data_preproc_tsne, BQ_TABLENAME_TSNE)
 
-    print("\nLoading model...")
-    model = load_model()
+    features = clustering_matrix(data_preproc_tsne)
+
+    if model_type == 'minibatch':
+        # Warm start from the production centroids and stream the data by batches
+        print("\nLoading model...")
+        model = load_model()
+        if model is not None and getattr(model, 'cluster_centers_', None) is not None \
+                and model.cluster_centers_.shape[1] == features.shape[1]:
+            model = warm_start_model(model, batch_size=batch_size)
+        else:
+            model = initialize_model_minibatch(batch_size=batch_size)
 
-    if model is None:
+        print("\nFitting model by batches...")
+        model = partial_fit_model(model, iter_batches(features, batch_size=batch_size))
+        labels = model.predict(features)
+    else:
+        # A new model of model_type every time, the Production one is only
+        # reused to warm start minibatch
         if model_type == 'kmeans':
             model = initialize_model_kmeans()
         else:
-            model = initialize_model_spectral()
+            model = initialize_model_spectral(max_samples=max_samples)
 
-    print("\nFitting model...")
-    model = fit_model(model, data_preproc_tsne)
+        print("\nFitting model...")
+        model = fit_model(model, features)
+        labels = model.labels_
 
-    save_model(model=model)
-
-    if MODEL_TARGET == 'mlflow':
-        mlflow_transition_model(current_stage="None", new_stage="Production")
+    promote_model(model)
 
     # Create label column on data and save
-    data['label'] = model.labels_
+    data['label'] = labels
     data['idx'] = data.index
 
     data['Continent'] = data_continent
@@ -85,13 +163,185 @@ def fit(model_type = 'kmeans'):
     data['value_range'] = data_value_range
     data['league_level_bin'] = data_league_level_bin
 
-    load_data_to_bq(data,
+    upload_table(data, BQ_TABLENAME)
+
+    print("✅ fit() done \n")
+
+
+@mlflow_run
+def sweep(model_type = 'kmeans', n_clusters_list = range(16, 49, 4), max_workers = None,
+          sample_size = 10000, max_samples = None):
+    """
+    - Load the tsne table (or from cache if it exists)
+    - Fit a model for each number of clusters in parallel, score each one on a sample
+    - Log the scores, promote the model with the best silhouette and update the labels
+    """
+
+    print("\n⭐️ Use case: sweep")
+
+    players, tsne = load_players_tables()
+    if not (players['idx'].to_numpy() == tsne['idx'].to_numpy()).all():
+        print("❌ Players and tsne tables are not aligned, run fit() first")
+        return None
+
+    print(f"\nFitting {model_type} for {list(n_clusters_list)} clusters...")
+    results = sweep_n_clusters(clustering_matrix(tsne), list(n_clusters_list),
+                               model_type=model_type, max_workers=max_workers,
+                               sample_size=sample_size, max_samples=max_samples)
+
+    for n_clusters, (_, scores) in results.items():
+        print(f"{n_clusters} clusters: silhouette {scores['silhouette']:.3f}, "
+              f"calinski_harabasz {scores['calinski_harabasz']:.0f}, {scores['fit_seconds']:.1f}s")
+
+    best = max(results, key=lambda n_clusters: results[n_clusters][1]['silhouette'])
+    model = results[best][0]
+
+    save_results(params={'sweep_model_type': model_type,
+                         'sweep_n_clusters': ','.join(str(n_clusters) for n_clusters in results),
+                         'sweep_best_n_clusters': best},
+                 metrics={f'{name}_{n_clusters}': value
+                          for n_clusters, (_, scores) in results.items()
+                          for name, value in scores.items()})
+
+    promote_model(model)
+
+    players['label'] = model.labels_
+
+    forget_uploads(BQ_TABLENAME)
+    load_data_to_bq(players,
         gcp_project=GCP_PROJECT,
         bq_dataset=BQ_DATASET,
         table=BQ_TABLENAME,
         truncate=True)
 
-    print("✅ fit() done \n")
+    print(f"✅ sweep() done, {best} clusters promoted \n")
+
+    return best
+
+
+def preprocess_players(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    - Load the preprocessing pipeline fitted by the last fit()
+    - Project new or updated players (raw players table rows) into the same
+      feature space, without refitting anything
+    """
+
+    print("\n⭐️ Use case: preprocess players")
+
+    preprocessor = load_preprocessor()
+    if preprocessor is None:
+        print("❌ No fitted preprocessor, run fit() first")
+        return None
+
+    data_preproc = transform_players(preprocessor, data)
+
+    print(f"✅ preprocess_players() done, {data_preproc.shape[0]} players \n")
+
+    return data_preproc
+
+
+def load_players_tables():
+    """
+    Return the players and tsne tables (from BQ or from the cache of their current version), both ordered by idx
+    """
+
+    players_query = f"""
+        SELECT *
+        FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME}
+        ORDER BY idx
+    """
+    tsne_query = f"""
+        SELECT *
+        FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME_TSNE}
+        ORDER BY idx
+    """
+    players = get_data_with_cache(gcp_project=GCP_PROJECT, query=players_query,
+                                  cache_path=Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME}.{DATA_CACHE_FORMAT}"),
+                                  version=table_version(GCP_PROJECT, BQ_DATASET, BQ_TABLENAME))
+    tsne = get_data_with_cache(gcp_project=GCP_PROJECT, query=tsne_query,
+                               cache_path=Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME_TSNE}.{DATA_CACHE_FORMAT}"),
+                               version=table_version(GCP_PROJECT, BQ_DATASET, BQ_TABLENAME_TSNE))
+
+    return players, tsne
+
+
+@mlflow_run
+def embed_players(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    - Place new or changed players (rows of the players table schema, with idx,
+      without label) in the existing tsne space, without moving the other players
+    - Label them with the Production model; a MiniBatchKMeans model is first
+      updated with partial_fit on their points only (delta fit) and promoted
+    - Replace only their rows in the players and tsne tables
+    """
+
+    print("\n⭐️ Use case: embed players")
+
+    preprocessor = load_preprocessor()
+    reducer = load_embedding()
+    model = load_model()
+    if preprocessor is None or reducer is None or model is None:
+        print("❌ No fitted preprocessor, embedding or model, run fit() first")
+        return None
+
+    players, tsne = load_players_tables()
+
+    # Changed players are placed from the others, not from their previous point
+    changed = data['idx'].isin(players['idx'])
+    reference = ~players['idx'].isin(data['idx']).to_numpy()
+
+    new_features = transform_players(preprocessor, data)
+    reference_features = None
+    if not hasattr(reducer, 'transform'):
+        reference_features = transform_players(preprocessor, players[reference])
+
+    reference_embedding = clustering_matrix(tsne)[reference]
+    embedding = embed_new_players(new_features, reducer=reducer,
+                                  reference_features=reference_features,
+                                  reference_embedding=reference_embedding)
+
+    data_tsne = pd.DataFrame(embedding, columns=tsne.columns.drop('idx'))
+    data_tsne['idx'] = data['idx'].to_numpy()
+
+    data = data.copy()
+    if getattr(model, 'n_features_in_', embedding.shape[1]) != embedding.shape[1]:
+        print("❌ Production model fitted on other features, run fit() first")
+        return None
+    if hasattr(model, 'partial_fit'):
+        # Loaded models are shared through the registry cache
+        model = copy.deepcopy(model)
+        print("\nUpdating model with the embedded players...")
+        model = partial_fit_model(model, iter_batches(embedding))
+        promote_model(model)
+    if hasattr(model, 'predict'):
+        data['label'] = model.predict(embedding)
+    else:
+        # Models without predict (spectral) give the label of the closest player
+        closest = interpolate_embedding(reference_embedding, players['label'].to_numpy()[reference, None],
+                                        embedding, n_neighbors=1)
+        data['label'] = closest[:, 0].astype(int)
+
+    forget_uploads(BQ_TABLENAME, BQ_TABLENAME_TSNE)
+    if changed.any():
+        changed_idx = data.loc[changed, 'idx'].tolist()
+        for table in (BQ_TABLENAME, BQ_TABLENAME_TSNE):
+            delete_from_bq(gcp_project=GCP_PROJECT, bq_dataset=BQ_DATASET, table=table, idx=changed_idx)
+
+    load_data_to_bq(data_tsne,
+        gcp_project=GCP_PROJECT,
+        bq_dataset=BQ_DATASET,
+        table=BQ_TABLENAME_TSNE,
+        truncate=False)
+
+    load_data_to_bq(data[players.columns],
+        gcp_project=GCP_PROJECT,
+        bq_dataset=BQ_DATASET,
+        table=BQ_TABLENAME,
+        truncate=False)
+
+    print(f"✅ embed_players() done, {(~changed).sum()} new and {changed.sum()} changed players \n")
+
+    return data_tsne
 
 
 if __name__ == '__main__':
@@ -1,5 +1,14 @@
-from sklearn.cluster import KMeans
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.base import BaseEstimator, ClusterMixin
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.cluster import SpectralClustering
+from sklearn.metrics import calinski_harabasz_score, silhouette_score
+from sklearn.neighbors import KNeighborsClassifier
 
 
 def initialize_model_kmeans(n_clusters = 32):
@@ -10,16 +19,106 @@ def initialize_model_kmeans(n_clusters = 32):
     model = KMeans(n_clusters = n_clusters)
     return model
 
-def initialize_model_spectral(n_clusters = 32, assign_labels = 'kmeans', affinity = 'nearest_neighbors', n_init = 5):
+def initialize_model_minibatch(n_clusters = 32, batch_size = 4096):
+    '''
+    Function to return initialized model with MiniBatchKMeans
+    '''
+
+    model = MiniBatchKMeans(n_clusters = n_clusters,
+                            batch_size = batch_size,
+                            n_init = 3)
+    return model
+
+def warm_start_model(production_model, batch_size = 4096):
+    '''
+    Function to return a MiniBatchKMeans initialized with the centroids of the
+    production model (KMeans or MiniBatchKMeans), so that refits only move them
+    '''
+
+    model = MiniBatchKMeans(n_clusters = production_model.cluster_centers_.shape[0],
+                            init = production_model.cluster_centers_,
+                            batch_size = batch_size,
+                            n_init = 1)
+    return model
+
+def initialize_model_spectral(n_clusters = 32, assign_labels = 'kmeans', affinity = 'nearest_neighbors', n_init = 5,
+                              max_samples = None, n_jobs = -1):
     '''
     Function to return initialized model with Spectral Clustering
+    With max_samples, the affinity graph is only built on a sample of that size
+    (see SampledSpectralClustering), bounding the memory used by the fit
     '''
 
+    if max_samples is not None:
+        return SampledSpectralClustering(n_clusters = n_clusters,
+                                         assign_labels = assign_labels,
+                                         n_init = n_init,
+                                         max_samples = max_samples,
+                                         n_jobs = n_jobs)
+
     model = SpectralClustering(n_clusters = n_clusters,
                                assign_labels = assign_labels,
                                affinity = affinity,
                                n_init = n_init,
-                               n_jobs=-1)
+                               n_jobs = n_jobs)
+    return model
+
+class SampledSpectralClustering(ClusterMixin, BaseEstimator):
+    '''
+    Spectral Clustering fitted on at most max_samples points, the other points
+    get the label of their closest sampled point
+    '''
+
+    def __init__(self, n_clusters = 32, assign_labels = 'kmeans', n_init = 5, n_neighbors = 10,
+                 max_samples = 20000, random_state = None, n_jobs = -1):
+        self.n_clusters = n_clusters
+        self.assign_labels = assign_labels
+        self.n_init = n_init
+        self.n_neighbors = n_neighbors
+        self.max_samples = max_samples
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y = None):
+        X = np.asarray(X, dtype=float)
+        rng = np.random.default_rng(self.random_state)
+
+        sample = np.arange(X.shape[0])
+        if X.shape[0] > self.max_samples:
+            sample = np.sort(rng.choice(X.shape[0], self.max_samples, replace=False))
+
+        spectral = SpectralClustering(n_clusters = self.n_clusters,
+                                      assign_labels = self.assign_labels,
+                                      affinity = 'nearest_neighbors',
+                                      n_neighbors = self.n_neighbors,
+                                      n_init = self.n_init,
+                                      random_state = self.random_state,
+                                      n_jobs = self.n_jobs)
+        sample_labels = spectral.fit_predict(X[sample])
+
+        self.classifier_ = KNeighborsClassifier(n_neighbors=1).fit(X[sample], sample_labels)
+        self.labels_ = self.predict(X)
+        return self
+
+    def predict(self, X):
+        return self.classifier_.predict(np.asarray(X, dtype=float))
+
+def iter_batches(data, batch_size = 4096):
+    '''
+    Function to yield the successive batches of batch_size rows of data
+    '''
+
+    for start in range(0, data.shape[0], batch_size):
+        yield data[start:start + batch_size]
+
+def partial_fit_model(model, batches):
+    '''
+    Function to return the model updated with partial_fit on each batch of
+    batches (any iterable, e.g. iter_batches or a stream of new players)
+    '''
+
+    for batch in batches:
+        model.partial_fit(batch)
     return model
 
 def fit_model(model, data):
@@ -29,3 +128,74 @@ def fit_model(model, data):
 
     fitted_model = model.fit(data)
     return fitted_model
+
+def score_model(data, labels, sample_size = 10000, random_state = 0):
+    '''
+    Function to return the silhouette and Calinski-Harabasz scores of labels,
+    computed on a sample of sample_size rows of data
+    '''
+
+    data = np.asarray(data)
+    rng = np.random.default_rng(random_state)
+    sample = np.arange(data.shape[0])
+    if data.shape[0] > sample_size:
+        sample = rng.choice(data.shape[0], sample_size, replace=False)
+
+    return {'silhouette': float(silhouette_score(data[sample], labels[sample])),
+            'calinski_harabasz': float(calinski_harabasz_score(data[sample], labels[sample]))}
+
+def fit_and_score(data_path, model_type, n_clusters, sample_size = 10000, max_samples = None, n_threads = 1):
+    '''
+    Function to fit one model of the sweep on the memory-mapped array at
+    data_path and return it with its scores (run in a worker process).
+    model_type is 'kmeans', 'spectral' or 'minibatch', the model uses at most
+    n_threads threads (BLAS / OpenMP and joblib)
+    '''
+
+    from threadpoolctl import threadpool_limits
+
+    data = np.load(data_path, mmap_mode='r')
+
+    with threadpool_limits(limits=n_threads):
+        start = time.perf_counter()
+        if model_type == 'kmeans':
+            model = initialize_model_kmeans(n_clusters=n_clusters)
+        elif model_type == 'minibatch':
+            model = initialize_model_minibatch(n_clusters=n_clusters)
+        elif model_type == 'spectral':
+            # threadpool_limits does not cap joblib workers
+            model = initialize_model_spectral(n_clusters=n_clusters, max_samples=max_samples, n_jobs=n_threads)
+        else:
+            raise ValueError(f"Unknown model_type {model_type!r}, expected 'kmeans', 'spectral' or 'minibatch'")
+        model = fit_model(model, data)
+        scores = score_model(data, model.labels_, sample_size=sample_size)
+
+    scores['fit_seconds'] = time.perf_counter() - start
+
+    return model, scores
+
+def sweep_n_clusters(data, n_clusters_list, model_type = 'kmeans', max_workers = None, sample_size = 10000,
+                     max_samples = None):
+    '''
+    Function to fit a model for each number of clusters of n_clusters_list in
+    parallel processes, all reading the same memory-mapped copy of data.
+    Return {n_clusters: (model, scores)}
+    '''
+
+    if model_type not in ('kmeans', 'spectral', 'minibatch'):
+        raise ValueError(f"Unknown model_type {model_type!r}, expected 'kmeans', 'spectral' or 'minibatch'")
+
+    max_workers = max_workers or min(len(n_clusters_list), os.cpu_count())
+    n_threads = max(1, os.cpu_count() // max_workers)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'sweep.npy')
+        np.save(data_path, np.ascontiguousarray(data, dtype=float))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {n_clusters: executor.submit(fit_and_score, data_path, model_type, n_clusters,
+                                                   sample_size, max_samples, n_threads)
+                       for n_clusters in n_clusters_list}
+            results = {n_clusters: future.result() for n_clusters, future in futures.items()}
+
+    return results
@@ -3,6 +3,7 @@ import os
 ##################  VARIABLES  ##################
 DATA_SIZE = os.environ.get("DATA_SIZE")
 MODEL_TARGET = os.environ.get("MODEL_TARGET")
+DATA_TARGET = os.environ.get("DATA_TARGET", "bigquery")
 GCP_PROJECT = os.environ.get("GCP_PROJECT")
 GCP_REGION = os.environ.get("GCP_REGION")
 BQ_DATASET = os.environ.get("BQ_DATASET")
@@ -25,3 +26,29 @@ GOOGLE_APPLICATION_CREDENTIALS = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"
 #LOCAL_REGISTRY_PATH =  os.path.join(os.path.expanduser('~'), ".lewagon", "mlops", "training_outputs")
 LOCAL_DATA_PATH = os.environ.get("LOCAL_DATA_PATH")
 LOCAL_REGISTRY_PATH = os.environ.get("LOCAL_REGISTRY_PATH")
+
+# Number of loaded models kept in memory by registry.load_model_file
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", 4))
+
+# Embedding used by preprocessor.preprocess_tsne: sklearn, opentsne, umap or pca
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "sklearn")
+
+# Format of the local data cache, "parquet" or "csv"
+DATA_CACHE_FORMAT = os.environ.get("DATA_CACHE_FORMAT", "parquet")
+
+CONTINENT_CACHE_PATH = os.environ.get("CONTINENT_CACHE_PATH", os.path.join(LOCAL_DATA_PATH or "", "continent_cache.json"))
+
+TRANSFERMARKT_URL = os.environ.get("TRANSFERMARKT_URL", "https://www.transfermarkt.com")
+
+STATS_CACHE_PATH = os.environ.get("STATS_CACHE_PATH", os.path.join(LOCAL_DATA_PATH or "", "statistics_cache.sqlite"))
+STATS_CACHE_TTL = int(os.environ.get("STATS_CACHE_TTL", 24 * 60 * 60))
+STATS_CACHE_MAX_ENTRIES = int(os.environ.get("STATS_CACHE_MAX_ENTRIES", 20000))
+
+# Token expected in the X-Admin-Token header of the API admin endpoints (disabled if unset)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Tables of DATA_TARGET="duckdb", one directory of Parquet files per table
+DUCKDB_PATH = os.environ.get("DUCKDB_PATH", os.path.join(LOCAL_DATA_PATH or "", "warehouse"))
+
+# Outputs of the fit stages, keyed by the hash of their inputs and parameters
+STAGE_CACHE_PATH = os.environ.get("STAGE_CACHE_PATH", os.path.join(LOCAL_DATA_PATH or "", "stage_cache"))
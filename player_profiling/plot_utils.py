@@ -1,13 +1,7 @@
-import plotly.graph_objects as go
-import plotly.express as px
 import pandas as pd
-from player_profiling.preprocessor import *
+import numpy as np
 
-def player_radar_plot(raw_data, index1 , index2):
-    raw_data['idx']=raw_data.index
-    #filtered_data= filter_data(raw_data)
-    filtered_data = raw_data
-    columns_to_keep = [
+RADAR_COLUMNS = [
     'attacking_crossing', 'attacking_finishing', 'attacking_heading_accuracy',
     'attacking_short_passing', 'attacking_volleys', 'skill_dribbling',
     'skill_curve', 'skill_fk_accuracy', 'skill_long_passing',
@@ -21,13 +15,44 @@ def player_radar_plot(raw_data, index1 , index2):
     'goalkeeping_diving', 'goalkeeping_handling', 'goalkeeping_kicking',
     'goalkeeping_positioning', 'goalkeeping_reflexes', 'goalkeeping_speed'
     ]
-    df_subset = filtered_data[columns_to_keep]
 
-    # 2. Group by Initial Work and Average
-    grouped_df = df_subset.groupby(lambda x: x.split('_')[0], axis=1).mean()
-    #categories = grouped_df.columns
+def build_radar_matrix(raw_data):
+    '''
+    Function to return the average of the skill columns per category
+    (prefix of the column name) for every player, as a float32 matrix
+    '''
+    categories = sorted({column.split('_')[0] for column in RADAR_COLUMNS})
+    df_subset = raw_data[RADAR_COLUMNS]
+
+    matrix = np.empty((len(raw_data), len(categories)), dtype=np.float32)
+    for i, category in enumerate(categories):
+        columns = [column for column in RADAR_COLUMNS if column.split('_')[0] == category]
+        matrix[:, i] = df_subset[columns].mean(axis=1).values
+
+    return {'categories': categories,
+            'matrix': matrix}
+
+def player_radar_plot(raw_data, player_indexes, radar_matrix = None):
+    '''
+    Function to return the category averages of the requested players only,
+    radar_matrix as returned by build_radar_matrix (built on the fly if None).
+    Raise IndexError if an index is not a row of raw_data (negative ones included)
+    '''
+    player_indexes = [int(index) for index in player_indexes]
+    out_of_range = [index for index in player_indexes if not 0 <= index < len(raw_data)]
+    if out_of_range:
+        raise IndexError(f"Player indexes out of range: {out_of_range}")
+
+    if radar_matrix is None:
+        radar_matrix = build_radar_matrix(raw_data)
+
+    grouped_df = pd.DataFrame(radar_matrix['matrix'][player_indexes],
+                              columns=radar_matrix['categories'])
+    grouped_df['idx'] = raw_data['idx'].values[player_indexes]
+    grouped_df['short_name'] = raw_data['short_name'].values[player_indexes]
 
     return {
+            'categories': radar_matrix['categories'],
             'grouped_df': grouped_df
     }
 
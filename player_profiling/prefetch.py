@@ -0,0 +1,106 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import requests
+
+from player_profiling.params import *
+from player_profiling.data import get_data_with_cache
+from player_profiling.scraping_utils import plot_metrics
+from player_profiling.statistics_cache import load_statistics, save_statistics
+from player_profiling.storage import table_version
+
+
+class RateLimiter:
+    '''
+    Spaces out calls to `wait` so that at most `rate` of them happen per second,
+    across all the threads sharing the limiter
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedSession(requests.Session):
+    '''
+    requests.Session waiting on a shared RateLimiter before every request
+    '''
+
+    def __init__(self, rate_limiter):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        self.rate_limiter.wait()
+        return super().request(*args, **kwargs)
+
+
+def prefetch_statistics(top_n=500, indexes=None, max_workers=4, requests_per_second=2, force=False):
+    '''
+    Scrape the Transfermarkt statistics of the `top_n` players by overall rating,
+    or of the given `indexes`, and store them in the statistics cache
+    - at most `max_workers` players are scraped at the same time
+    - all workers together send at most `requests_per_second` requests
+    - players already fresh in the cache are skipped unless `force`
+    '''
+
+    print("\n⭐️ Use case: prefetch statistics")
+
+    query = f"""
+        SELECT *
+        FROM {GCP_PROJECT}.{BQ_DATASET}.{BQ_TABLENAME}
+        ORDER BY idx
+    """
+
+    data_cache_path = Path(LOCAL_DATA_PATH).joinpath(f"{BQ_TABLENAME}.{DATA_CACHE_FORMAT}")
+    data = get_data_with_cache(
+        gcp_project=GCP_PROJECT,
+        query=query,
+        cache_path=data_cache_path,
+        data_has_header=True,
+        version=table_version(GCP_PROJECT, BQ_DATASET, BQ_TABLENAME)
+    )
+
+    if indexes is None:
+        indexes = data['overall'].nlargest(int(top_n)).index
+    indexes = [int(index) for index in indexes]
+
+    # The statistics cache is keyed by idx, `indexes` are rows of data
+    if not force:
+        indexes = [index for index in indexes if load_statistics(data['idx'].iloc[index]) is None]
+
+    print(f"\nScraping statistics of {len(indexes)} players...")
+
+    rate_limiter = RateLimiter(requests_per_second)
+    sessions = threading.local()
+
+    def scrape(index):
+        if not hasattr(sessions, 'session'):
+            sessions.session = RateLimitedSession(rate_limiter)
+        return plot_metrics(data, index, session=sessions.session)
+
+    scraped = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(scrape, index): index for index in indexes}
+        for future in as_completed(futures):
+            statistics = future.result()
+            if isinstance(statistics, dict) and not statistics['aggregated_data'].empty:
+                save_statistics(data['idx'].iloc[futures[future]], statistics)
+                scraped += 1
+
+    print(f"✅ prefetch_statistics() done, {scraped} / {len(indexes)} players cached \n")
+
+
+if __name__ == '__main__':
+    prefetch_statistics()
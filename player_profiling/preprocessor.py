@@ -1,8 +1,19 @@
+import numpy as np
 import pandas as pd
-from sklearn.impute import SimpleImputer
 from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
 from sklearn.preprocessing import StandardScaler, RobustScaler, MinMaxScaler, OneHotEncoder
 from sklearn.manifold import TSNE
+from sklearn.decomposition import PCA
+from sklearn.neighbors import NearestNeighbors
+import time
+
+from player_profiling.params import EMBEDDING_BACKEND
+from player_profiling.registry import save_results
+
+EMBEDDING_BACKENDS = ['sklearn', 'opentsne', 'umap', 'pca']
 
 
 #def scale_row(row, target_sum=100):
@@ -23,83 +34,96 @@ def scale_row(row):
         return row
     return row / total * 100
 
+# Characteristics scaled to sum up to 100 for every player
+CHARACTERISTICS = ['pace', 'shooting',
+   'passing', 'dribbling', 'defending', 'physic', 'attacking_crossing',
+   'attacking_finishing', 'attacking_heading_accuracy',
+   'attacking_short_passing', 'attacking_volleys', 'skill_dribbling',
+   'skill_curve', 'skill_fk_accuracy', 'skill_long_passing',
+   'skill_ball_control', 'movement_acceleration', 'movement_sprint_speed',
+   'movement_agility', 'movement_reactions', 'movement_balance',
+   'power_shot_power', 'power_jumping', 'power_stamina', 'power_strength',
+   'power_long_shots', 'mentality_aggression', 'mentality_interceptions',
+   'mentality_positioning', 'mentality_vision', 'mentality_penalties',
+   'mentality_composure', 'defending_marking_awareness',
+   'defending_standing_tackle', 'defending_sliding_tackle',
+   'goalkeeping_diving', 'goalkeeping_handling', 'goalkeeping_kicking',
+   'goalkeeping_positioning', 'goalkeeping_reflexes', 'goalkeeping_speed']
+
+# Columns returned by filter_data
+FEATURES = ['off_work_rate', 'def_work_rate', 'preferred_foot', 'age', 'height_cm',
+   'weight_kg', 'league_level', 'weak_foot', 'skill_moves', 'pace',
+   'shooting', 'passing', 'dribbling', 'physic', 'attacking_crossing',
+   'attacking_finishing', 'attacking_heading_accuracy',
+   'attacking_short_passing', 'attacking_volleys', 'skill_dribbling',
+   'skill_curve', 'skill_fk_accuracy', 'skill_long_passing',
+   'skill_ball_control', 'movement_acceleration', 'movement_sprint_speed',
+   'movement_agility', 'movement_reactions', 'movement_balance',
+   'power_shot_power', 'power_jumping', 'power_stamina', 'power_strength',
+   'power_long_shots', 'mentality_aggression', 'mentality_interceptions',
+   'mentality_positioning', 'mentality_vision', 'mentality_penalties',
+   'mentality_composure', 'defending', 'defending_marking_awareness',
+   'defending_standing_tackle', 'defending_sliding_tackle',
+   'goalkeeping_diving', 'goalkeeping_handling', 'goalkeeping_kicking',
+   'goalkeeping_positioning', 'goalkeeping_reflexes', 'goalkeeping_speed']
+
+def scale_characteristics(characteristics):
+    '''
+    Vectorized scale_row over all the players at once:
+    every row is scaled to sum up to 100, rows summing to 0 are kept as is
+    '''
+    values = characteristics.to_numpy(dtype=float)
+    totals = np.nansum(values, axis=1, keepdims=True)
+    scaled = np.divide(values, totals, out=values.copy(), where=totals != 0)
+    scaled = np.multiply(scaled, 100, out=scaled, where=totals != 0)
+
+    return pd.DataFrame(scaled, index=characteristics.index, columns=characteristics.columns)
+
 def filter_data(df):
     '''
     Function to filter data to drop the useless columns of
-    the dataframe
+    the dataframe, without modifying df
     '''
 
-    #preferred_foot
-    df['preferred_foot'].replace({'Right':1, 'Left':0}, inplace= True)
+    #preferred_foot, already 1/0 in a players table written by a previous fit
+    preferred_foot = pd.to_numeric(df['preferred_foot'].replace({'Right':'1', 'Left':'0'}))
 
     #work_rate (offensive/defensive)
-    df[['off_work_rate','def_work_rate']] = df['work_rate'].str.split('/', expand=True)
+    work_rate = df['work_rate'].str.split('/', expand=True)
     priority_mapping = {'High': 3, 'Medium': 2, 'Low': 1}
-    df['off_work_rate']=df['off_work_rate'].map(priority_mapping)
-    df['def_work_rate']=df['def_work_rate'].map(priority_mapping)
 
     #scale all the characteristics to sum up to 100
-    characteristics= df[['pace', 'shooting',
-       'passing', 'dribbling', 'defending', 'physic', 'attacking_crossing',
-       'attacking_finishing', 'attacking_heading_accuracy',
-       'attacking_short_passing', 'attacking_volleys', 'skill_dribbling',
-       'skill_curve', 'skill_fk_accuracy', 'skill_long_passing',
-       'skill_ball_control', 'movement_acceleration', 'movement_sprint_speed',
-       'movement_agility', 'movement_reactions', 'movement_balance',
-       'power_shot_power', 'power_jumping', 'power_stamina', 'power_strength',
-       'power_long_shots', 'mentality_aggression', 'mentality_interceptions',
-       'mentality_positioning', 'mentality_vision', 'mentality_penalties',
-       'mentality_composure', 'defending_marking_awareness',
-       'defending_standing_tackle', 'defending_sliding_tackle',
-       'goalkeeping_diving', 'goalkeeping_handling', 'goalkeeping_kicking',
-       'goalkeeping_positioning', 'goalkeeping_reflexes', 'goalkeeping_speed']]
-
-    characteristics['goalkeeping_speed'].fillna(0, inplace=True)
-
-    scaled_characteristics = characteristics.apply(scale_row, axis=1)
+    characteristics = df[CHARACTERISTICS].fillna({'goalkeeping_speed': 0})
+    scaled_characteristics = scale_characteristics(characteristics)
 
-    # Concatenate the DataFrames
-    merged_df = pd.concat([df, scaled_characteristics], axis=1)
+    merged_df = pd.concat([
+        work_rate[0].map(priority_mapping).rename('off_work_rate'),
+        work_rate[1].map(priority_mapping).rename('def_work_rate'),
+        preferred_foot,
+        df[['age', 'height_cm', 'weight_kg', 'league_level', 'weak_foot', 'skill_moves']],
+        scaled_characteristics,
+    ], axis=1)
 
-    # Overwrite columns from df with corresponding columns from scaled_characteristics
-    #merged_df.update(scaled_characteristics)
-
-    # Drop duplicate columns, keeping only the last occurrence (from scaled_characteristics)
-    merged_df = merged_df.loc[:,~merged_df.columns.duplicated(keep='last')]
+    return merged_df[FEATURES]
 
+def impute_mean(df):
+    '''
+    Function to replace the missing values of every column by the column mean,
+    in a single pass over the data
+    '''
+    values = df.to_numpy(dtype=float)
+    means = np.nanmean(values, axis=0)
 
-    merged_df = merged_df[['off_work_rate', 'def_work_rate', 'preferred_foot', 'age', 'height_cm',
-       'weight_kg', 'league_level', 'weak_foot', 'skill_moves', 'pace',
-       'shooting', 'passing', 'dribbling', 'physic', 'attacking_crossing',
-       'attacking_finishing', 'attacking_heading_accuracy',
-       'attacking_short_passing', 'attacking_volleys', 'skill_dribbling',
-       'skill_curve', 'skill_fk_accuracy', 'skill_long_passing',
-       'skill_ball_control', 'movement_acceleration', 'movement_sprint_speed',
-       'movement_agility', 'movement_reactions', 'movement_balance',
-       'power_shot_power', 'power_jumping', 'power_stamina', 'power_strength',
-       'power_long_shots', 'mentality_aggression', 'mentality_interceptions',
-       'mentality_positioning', 'mentality_vision', 'mentality_penalties',
-       'mentality_composure', 'defending', 'defending_marking_awareness',
-       'defending_standing_tackle', 'defending_sliding_tackle',
-       'goalkeeping_diving', 'goalkeeping_handling', 'goalkeeping_kicking',
-       'goalkeeping_positioning', 'goalkeeping_reflexes', 'goalkeeping_speed']]
+    rows, columns = np.nonzero(np.isnan(values))
+    values[rows, columns] = means[columns]
 
-    return merged_df
+    return pd.DataFrame(values, index=df.index, columns=df.columns)
 
-def preprocess(df):
+def build_column_transformer(handle_unknown = 'error'):
     '''
-    Function to return the preprocessed data
+    Function to return the unfitted scaling/encoding transformer of preprocess
     '''
 
-    # Instantiate a SimpleImputer object with your strategy of choice
-    imputer = SimpleImputer(strategy="mean")
-
-    for c in df.columns:
-        # Call the "fit" method on the object
-        imputer.fit(df[[c]])
-        # Call the "transform" method on the object
-        df[c] = imputer.transform(df[[c]])
-
     # Define the features based on categories
     binary_features = ['preferred_foot']
     one_hot_features = ['off_work_rate', 'def_work_rate']
@@ -122,32 +146,157 @@ def preprocess(df):
         'goalkeeping_speed']
 
     # Create a column transformer
-    preprocessor_ = ColumnTransformer(
+    return ColumnTransformer(
         transformers=[
             ('binary', OneHotEncoder(drop='if_binary'), binary_features),
-            ('one_hot', OneHotEncoder(), one_hot_features),
+            ('one_hot', OneHotEncoder(handle_unknown=handle_unknown), one_hot_features),
             ('standard_scaling', StandardScaler(), standard_scaling_features),
             ('robust_scaling', RobustScaler(), robust_scaling_features),
             ('minmax_scaling', MinMaxScaler(), minmax_scaling_features),
         ], remainder= 'passthrough')
+
+def preprocess(df):
+    '''
+    Function to return the preprocessed data
+    '''
+
+    df = impute_mean(df)
+
+    preprocessor_ = build_column_transformer()
     preprocessor_.fit(df)
 
     df_preproc = preprocessor_.transform(df)
 
     return pd.DataFrame(df_preproc)
 
-def preprocess_tsne(df, perplexity = 30, early_exaggeration = 12):
+def build_preprocessing_pipeline():
+    '''
+    Function to return the unfitted pipeline chaining filter_data, the mean
+    imputation and the scaling of preprocess. Fitted once on the raw players
+    data and persisted, it transforms new players into the same feature space
+    '''
+
+    return Pipeline([
+        ('filter', FunctionTransformer(filter_data)),
+        ('impute', SimpleImputer(strategy='mean').set_output(transform='pandas')),
+        ('scale', build_column_transformer(handle_unknown='ignore')),
+    ])
+
+def fit_preprocessing_pipeline(df):
+    '''
+    Function to return the preprocessing pipeline fitted on df, along with
+    df preprocessed by it
+    '''
+
+    pipeline = build_preprocessing_pipeline()
+    df_preproc = pd.DataFrame(pipeline.fit_transform(df))
+
+    return pipeline, df_preproc
+
+def transform_players(pipeline, df):
+    '''
+    Function to return raw players data preprocessed by the fitted pipeline,
+    without refitting anything
+    '''
+
+    return pd.DataFrame(pipeline.transform(df), index=df.index)
+
+def build_embedding(df, backend = 'sklearn', n_components = 3, perplexity = 30, early_exaggeration = 12):
+    '''
+    Function to return the embedding of df with the given backend, along with
+    the fitted reducer and the parameters used
+    - 'sklearn': exact-API scikit-learn TSNE (historical behaviour)
+    - 'opentsne': multithreaded openTSNE, FFT-accelerated for up to 2 components
+      (Barnes-Hut above, FFT interpolation only supports 1 or 2 dimensions)
+    - 'umap': umap-learn UMAP
+    - 'pca': scikit-learn PCA
+    '''
+
+    if backend == 'sklearn':
+        params = {'perplexity': perplexity, 'early_exaggeration': early_exaggeration,
+                  'learning_rate': 'auto', 'init': 'pca'}
+        reducer = TSNE(n_components=n_components, **params)
+        embedding = reducer.fit_transform(df)
+
+    elif backend == 'opentsne':
+        from openTSNE import TSNE as OpenTSNE
+
+        params = {'perplexity': perplexity, 'early_exaggeration': early_exaggeration,
+                  'initialization': 'pca', 'n_jobs': -1,
+                  'negative_gradient_method': 'fft' if n_components <= 2 else 'bh'}
+        reducer = OpenTSNE(n_components=n_components, **params).fit(np.asarray(df, dtype=float))
+        embedding = np.asarray(reducer)
+
+    elif backend == 'umap':
+        import umap
+
+        params = {'n_neighbors': int(perplexity), 'min_dist': 0.1, 'n_jobs': -1}
+        reducer = umap.UMAP(n_components=n_components, **params)
+        embedding = reducer.fit_transform(df)
+
+    elif backend == 'pca':
+        params = {}
+        reducer = PCA(n_components=n_components)
+        embedding = reducer.fit_transform(df)
+
+    else:
+        raise ValueError(f"Unknown embedding backend {backend}, use one of {EMBEDDING_BACKENDS}")
+
+    return embedding, reducer, params
+
+def preprocess_tsne(df, perplexity = 30, early_exaggeration = 12, backend = None, return_reducer = False):
+    '''
+    Function to return the preprocessed data after run the TSNE,
+    or the embedding backend given by backend / EMBEDDING_BACKEND.
+    The backend runtime and parameters are recorded through save_results.
+    With return_reducer, also return the fitted reducer (see embed_new_players)
+    '''
+
+    backend = backend or EMBEDDING_BACKEND
+
+    start = time.perf_counter()
+    embedding, reducer, params = build_embedding(df, backend=backend, perplexity=perplexity,
+                                           early_exaggeration=early_exaggeration)
+    runtime = time.perf_counter() - start
+
+    print(f"✅ {backend} embedding done in {runtime:.1f}s")
+    save_results(params={'embedding_backend': backend,
+                         **{f'embedding_{key}': value for key, value in params.items()}},
+                 metrics={'embedding_seconds': runtime})
+
+    if return_reducer:
+        return embedding, reducer
+
+    return embedding
+
+def interpolate_embedding(reference_features, reference_embedding, new_features, n_neighbors = 10):
+    '''
+    Function to return the coordinates of new_features in the reference
+    embedding, as the inverse distance weighted mean of the embedding of their
+    n_neighbors closest reference players in the feature space
+    '''
+
+    reference_embedding = np.asarray(reference_embedding, dtype=float)
+    n_neighbors = min(n_neighbors, len(reference_embedding))
+
+    neighbors = NearestNeighbors(n_neighbors=n_neighbors).fit(np.asarray(reference_features, dtype=float))
+    distances, positions = neighbors.kneighbors(np.asarray(new_features, dtype=float))
+
+    weights = 1 / np.maximum(distances, 1e-12)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    return np.einsum('ij,ijk->ik', weights, reference_embedding[positions])
+
+def embed_new_players(new_features, reducer = None, reference_features = None, reference_embedding = None,
+                      n_neighbors = 10):
     '''
-    Function to return the preprocessed data after run the TSNE
+    Function to return the coordinates of new_features in an existing embedding,
+    without moving the existing points:
+    - with reducer.transform if the fitted reducer has one (openTSNE, UMAP, PCA)
+    - else by kNN interpolation from the reference players (sklearn TSNE)
     '''
 
-    tsne = TSNE(
-        n_components=3,
-        learning_rate='auto',
-        perplexity=perplexity,
-        early_exaggeration=early_exaggeration,
-        init='pca'
-    )
-    print(df.columns)
+    if reducer is not None and hasattr(reducer, 'transform'):
+        return np.asarray(reducer.transform(np.asarray(new_features, dtype=float)))
 
-    return tsne.fit_transform(df)
+    return interpolate_embedding(reference_features, reference_embedding, new_features, n_neighbors=n_neighbors)
@@ -1,13 +1,24 @@
 import glob
+import hashlib
+import json
 import os
 import time
 import pickle
+from contextlib import contextmanager
+from functools import lru_cache
 
-from tensorflow import keras
+import joblib
 
 from player_profiling.params import *
-import mlflow
-from mlflow.tracking import MlflowClient
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no advisory locks, the manifest is still replaced atomically
+    fcntl = None
+
+# tensorflow and mlflow are slow to import and unused by the serving path,
+# they are imported by the functions that need them
 
 def save_results(params: dict, metrics: dict) -> None:
     """
@@ -17,6 +28,8 @@ def save_results(params: dict, metrics: dict) -> None:
     if MODEL_TARGET='mlflow', also persist them on MLflow
     """
     if MODEL_TARGET == "mlflow":
+        import mlflow
+
         if params is not None:
             mlflow.log_params(params)
         if metrics is not None:
@@ -40,22 +53,105 @@ def save_results(params: dict, metrics: dict) -> None:
     print("✅ Results saved locally")
 
 
-def save_model(model: keras.Model = None) -> None:
+def local_models_directory() -> str:
     """
-    Persist trained model locally on the hard drive at f"{LOCAL_REGISTRY_PATH}/models/{timestamp}.h5"
-    - if MODEL_TARGET='mlflow', also persist it on MLflow
+    Return the directory of the local registry models (also the download cache
+    of MLflow models), creating it if needed
     """
+    directory = os.path.join(LOCAL_REGISTRY_PATH, "models")
+    os.makedirs(directory, exist_ok=True)
+    return directory
 
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
 
-    # Save model locally
-    model_path = os.path.join(LOCAL_REGISTRY_PATH, "models", f"{timestamp}.h5")
-    with open(model_path, "wb") as file:
-        pickle.dump(model, file)
+@contextmanager
+def local_manifest(write: bool = False):
+    """
+    Yield the local registry manifest {"models": [{version, checksum, stage, source, created_at}]}
+    - with `write`, hold an exclusive lock and atomically save the manifest on exit
+    """
+    manifest_path = os.path.join(local_models_directory(), "manifest.json")
+
+    with open(manifest_path + ".lock", "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+
+        manifest = {"models": []}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+
+        yield manifest
+
+        if write:
+            tmp_path = manifest_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(manifest, file, indent=2)
+            os.replace(tmp_path, manifest_path)
+
+
+def file_checksum(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def store_model_locally(model, stage: str = "None", source: str = None, kind: str = "model") -> dict:
+    """
+    Persist `model` in the local registry at f"{LOCAL_REGISTRY_PATH}/models/{sha256}.joblib"
+    (stored once per content) and register it as a new version in the manifest
+    - `kind` tells clustering models ("model") from other fitted artifacts ("preprocessor", "embedding")
+    """
+    tmp_path = os.path.join(local_models_directory(), f"{os.getpid()}-{time.time_ns()}.joblib.tmp")
+    joblib.dump(model, tmp_path)
+
+    checksum = file_checksum(tmp_path)
+    os.replace(tmp_path, os.path.join(local_models_directory(), f"{checksum}.joblib"))
+
+    with local_manifest(write=True) as manifest:
+        entry = {
+            "version": max([m["version"] for m in manifest["models"]], default=0) + 1,
+            "kind": kind,
+            "checksum": checksum,
+            "stage": stage,
+            "source": source,
+            "created_at": time.strftime("%Y%m%d-%H%M%S")
+        }
+        manifest["models"].append(entry)
+
+    return entry
+
 
-    print("✅ Model saved locally")
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_model_file(checksum: str):
+    """
+    Load the model stored under `checksum`, memory-mapping its arrays.
+    Loaded models are kept in an in-process LRU cache: they are shared,
+    copy them before mutating
+    """
+    model_path = os.path.join(local_models_directory(), f"{checksum}.joblib")
+
+    if file_checksum(model_path) != checksum:
+        raise ValueError(f"Checksum mismatch for {model_path}")
+
+    return joblib.load(model_path, mmap_mode="r")
+
+
+def save_model(model = None) -> None:
+    """
+    Persist trained model in the local registry (content-addressed, see store_model_locally)
+    with stage "None"
+    - if MODEL_TARGET='mlflow', also persist it on MLflow
+    """
+
+    entry = store_model_locally(model)
+
+    print(f"✅ Model saved locally (version {entry['version']})")
 
     if MODEL_TARGET == "mlflow":
+        import mlflow.sklearn
+
         mlflow.sklearn.log_model(
             sk_model=model,
             artifact_path="model",
@@ -69,39 +165,53 @@ def save_model(model: keras.Model = None) -> None:
     return None
 
 
-def load_model(stage="Production") -> keras.Model:
+def load_model(stage="Production"):
     """
     Return a saved model:
-    - locally (latest one in alphabetical order)
-    - or from MLFLOW (by "stage") if MODEL_TARGET=='mlflow'
+    - locally (latest version in "stage" from the local registry manifest)
+    - or from MLFLOW (by "stage") if MODEL_TARGET=='mlflow', downloaded once
+      and then served from the local registry
 
     Return None (but do not Raise) if no model is found
 
     """
 
     if MODEL_TARGET == "local":
-        print(f"\nLoad latest model from local registry...")
+        print(f"\nLoad latest [{stage}] model from local registry...")
 
-        # Get the latest model version name by the timestamp on disk
-        local_model_directory = os.path.join(LOCAL_REGISTRY_PATH, "models")
-        local_model_paths = glob.glob(f"{local_model_directory}/*")
+        with local_manifest() as manifest:
+            entries = [m for m in manifest["models"]
+                       if m["stage"] == stage and m.get("kind", "model") == "model"]
 
-        if not local_model_paths:
-            return None
+        if not entries:
+            # Registry written before the manifest existed: latest pickled model
+            local_model_paths = glob.glob(f"{local_models_directory()}/*.h5")
+
+            if manifest["models"] or not local_model_paths:
+                return None
 
-        most_recent_model_path_on_disk = sorted(local_model_paths)[-1]
+            most_recent_model_path_on_disk = sorted(local_model_paths)[-1]
+            with open(most_recent_model_path_on_disk, "rb") as file:
+                latest_model = pickle.load(file)
 
-        print(f"\nLoad latest model from disk...")
+            print("✅ Model loaded from local disk (legacy pickle)")
 
-        latest_model = keras.models.load_model(most_recent_model_path_on_disk)
+            return latest_model
 
-        print("✅ Model loaded from local disk")
+        latest_entry = max(entries, key=lambda m: m["version"])
+        latest_model = load_model_file(latest_entry["checksum"])
+
+        print(f"✅ Model loaded from local disk (version {latest_entry['version']})")
 
         return latest_model
 
     elif MODEL_TARGET == "mlflow":
         print(f"\nLoad [{stage}] model from MLflow...")
 
+        import mlflow
+        import mlflow.sklearn
+        from mlflow.tracking import MlflowClient
+
         # Load model from MLflow
         model = None
         mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
@@ -117,7 +227,19 @@ def load_model(stage="Production") -> keras.Model:
 
             return None
 
+        # Serve it from the local registry if it was already downloaded
+        with local_manifest() as manifest:
+            entries = [m for m in manifest["models"] if m["source"] == model_uri]
+
+        if entries:
+            model = load_model_file(entries[-1]["checksum"])
+
+            print("✅ Model loaded from local registry (cached from MLflow)")
+            return model
+
         model = mlflow.sklearn.load_model(model_uri=model_uri)
+        entry = store_model_locally(model, source=model_uri)
+        model = load_model_file(entry["checksum"])
 
         print("✅ Model loaded from MLflow")
         return model
@@ -125,12 +247,107 @@ def load_model(stage="Production") -> keras.Model:
         return None
 
 
+def local_transition_model(current_stage: str, new_stage: str) -> None:
+    """
+    Transition the latest local model from the `current_stage` to the
+    `new_stage` and archive the existing local models in `new_stage`
+    """
+    with local_manifest(write=True) as manifest:
+        entries = [m for m in manifest["models"]
+                   if m["stage"] == current_stage and m.get("kind", "model") == "model"]
+
+        if not entries:
+            print(f"\n❌ No local model found in stage {current_stage}")
+            return None
+
+        latest_entry = max(entries, key=lambda m: m["version"])
+        for entry in manifest["models"]:
+            if entry["stage"] == new_stage and entry.get("kind", "model") == "model":
+                entry["stage"] = "Archived"
+        latest_entry["stage"] = new_stage
+
+    print(f"✅ Local model (version {latest_entry['version']}) transitioned from {current_stage} to {new_stage}")
+
+    return None
+
+
+def save_artifact(artifact, kind: str) -> dict:
+    """
+    Persist a fitted artifact of `kind` (other than the clustering model) in the
+    local registry as the "Production" one, archiving the previous one
+    """
+    entry = store_model_locally(artifact, stage="Production", kind=kind)
+
+    with local_manifest(write=True) as manifest:
+        for m in manifest["models"]:
+            if m.get("kind") == kind and m["stage"] == "Production" and m["version"] != entry["version"]:
+                m["stage"] = "Archived"
+
+    print(f"✅ {kind.capitalize()} saved locally (version {entry['version']})")
+
+    return entry
+
+
+def load_artifact(kind: str, stage="Production"):
+    """
+    Return the latest fitted artifact of `kind` in `stage` from the local registry,
+    None if there is none
+    """
+    with local_manifest() as manifest:
+        entries = [m for m in manifest["models"] if m.get("kind") == kind and m["stage"] == stage]
+
+    if not entries:
+        print(f"\n❌ No {kind} found in stage {stage}")
+        return None
+
+    latest_entry = max(entries, key=lambda m: m["version"])
+    artifact = load_model_file(latest_entry["checksum"])
+
+    print(f"✅ {kind.capitalize()} loaded from local disk (version {latest_entry['version']})")
+
+    return artifact
+
+
+def save_preprocessor(pipeline) -> None:
+    """
+    Persist the fitted preprocessing pipeline in the local registry as the
+    "Production" preprocessor, archiving the previous one
+    """
+    save_artifact(pipeline, kind="preprocessor")
+
+
+def load_preprocessor(stage="Production"):
+    """
+    Return the latest fitted preprocessing pipeline in `stage` from the local registry,
+    None if there is none
+    """
+    return load_artifact("preprocessor", stage=stage)
+
+
+def save_embedding(reducer) -> None:
+    """
+    Persist the fitted embedding (openTSNE, UMAP or PCA reducer able to
+    `transform` new players) in the local registry as the "Production" embedding
+    """
+    save_artifact(reducer, kind="embedding")
+
+
+def load_embedding(stage="Production"):
+    """
+    Return the latest fitted embedding in `stage` from the local registry,
+    None if there is none
+    """
+    return load_artifact("embedding", stage=stage)
+
 
 def mlflow_transition_model(current_stage: str, new_stage: str) -> None:
     """
     Transition the latest model from the `current_stage` to the
     `new_stage` and archive the existing model in `new_stage`
     """
+    import mlflow
+    from mlflow.tracking import MlflowClient
+
     mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
 
     client = MlflowClient()
@@ -163,6 +380,8 @@ def mlflow_run(func):
         - context (str, optional): Param describing the context of the run. Defaults to "Train".
     """
     def wrapper(*args, **kwargs):
+        import mlflow
+
         mlflow.end_run()
         mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
         mlflow.set_experiment(experiment_name=MLFLOW_EXPERIMENT)
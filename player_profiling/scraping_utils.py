@@ -1,9 +1,14 @@
+import asyncio
+from contextlib import nullcontext
+
 import requests
 from bs4 import BeautifulSoup
+import lxml.html
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 
+from player_profiling.params import TRANSFERMARKT_URL
+
 # Function to standardize season format
 def standardize_season_format(season):
     """Converts season formats to a standard 'YY/YY' format."""
@@ -12,73 +17,155 @@ def standardize_season_format(season):
         return f"{str(start_year)[-2:]}/{season[-2:]}"
     return season
 
+HEADERS = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.106 Safari/537.36'}
+
 # Function to create search URL
 def create_search_url(player_name):
-    base_search_url = "https://www.transfermarkt.com/schnellsuche/ergebnis/schnellsuche?query="
+    base_search_url = TRANSFERMARKT_URL + "/schnellsuche/ergebnis/schnellsuche?query="
     formatted_name = player_name.replace(" ", "+")
     return base_search_url + formatted_name
 
+# Function to find the detailed stats URL in the search results page
+def parse_search_page(content):
+    soup = BeautifulSoup(content, "html.parser")
+
+    player_url = soup.find("td", class_="hauptlink").find("a")['href']
+    player_url = player_url.replace("profil", "leistungsdatendetails")
+    player_url = player_url + '/saison//verein/0/liga/0/wettbewerb//pos/0/trainer_id/0/plus/1'
+    return TRANSFERMARKT_URL + player_url
+
+# Function to extract the per season stats from the detailed stats page
+def parse_player_page(content):
+    player_data = []
+    soup = BeautifulSoup(content, "html.parser")
+
+    position_element = soup.find_all("span", class_="data-header__content")[7]
+    position = position_element.get_text(strip=True) if position_element else "Unknown"
+
+    for row in soup.find("table", class_="items").find("tbody").find_all("tr", class_=["odd", "even"]):
+        columns = row.find_all("td")
+        season = columns[0].get_text(strip=True)
+        season = standardize_season_format(season)  # Standardize season format here
+        competition_link = columns[2].find("a", title=True)
+        competition = competition_link['title'] if competition_link else "Unknown"
+
+        if position == 'Goalkeeper':
+            appearances = int(columns[5].get_text(strip=True).replace("-", "0"))
+            ppg = float(columns[6].get_text(strip=True).replace("-", "0").replace(",", "."))
+            goals_conceded = int(columns[14].get_text(strip=True).replace("-", "0"))
+            clean_sheets = int(columns[15].get_text(strip=True).replace("-", "0"))
+            minutes_played = columns[16].get_text(strip=True).replace('-', '0').replace('.', '').replace('\'', '')
+            minutes_played = int(minutes_played) if minutes_played.isdigit() else 0
+            player_data.append({
+                'season': season,
+                'competition': competition,
+                'appearances': appearances,
+                'PPG': ppg,
+                'goals_conceded': goals_conceded,
+                'clean_sheets': clean_sheets,
+                'minutes_played': minutes_played
+            })
+        else:
+            appearances = int(columns[5].get_text(strip=True).replace("-", "0"))
+            ppg = float(columns[6].get_text(strip=True).replace("-", "0").replace(",", "."))
+            goals = int(columns[7].get_text(strip=True).replace("-", "0"))
+            assists = int(columns[8].get_text(strip=True).replace("-", "0"))
+            minutes_played = columns[17].get_text(strip=True).replace('-', '0').replace('.', '').replace('\'', '')
+            minutes_played = int(minutes_played) if minutes_played.isdigit() else 0
+            player_data.append({
+                'season': season,
+                'competition': competition,
+                'appearances': appearances,
+                'PPG': ppg,
+                'goals': goals,
+                'assists': assists,
+                'minutes_played': minutes_played
+            })
+
+    return pd.DataFrame(player_data)
+
+# Fast version of parse_search_page, lxml only looks for the first hauptlink cell
+def parse_search_page_fast(content):
+    tree = lxml.html.fromstring(content)
+
+    player_url = tree.xpath('(//td[contains(concat(" ", @class, " "), " hauptlink ")])[1]//a/@href')[0]
+    player_url = player_url.replace("profil", "leistungsdatendetails")
+    player_url = player_url + '/saison//verein/0/liga/0/wettbewerb//pos/0/trainer_id/0/plus/1'
+    return TRANSFERMARKT_URL + player_url
+
+# Fast version of parse_player_page, lxml extracts the needed columns of the
+# items table and the conversions run on whole columns at once
+def parse_player_page_fast(content):
+    tree = lxml.html.fromstring(content)
+
+    position_element = tree.xpath('//span[contains(concat(" ", @class, " "), " data-header__content ")]')[7]
+    position = position_element.text_content().strip()
+
+    rows = tree.xpath('(//table[contains(concat(" ", @class, " "), " items ")])[1]/tbody'
+                      '/tr[contains(concat(" ", @class, " "), " odd ") or contains(concat(" ", @class, " "), " even ")]')
+    if not rows:
+        return pd.DataFrame()
+
+    if position == 'Goalkeeper':
+        int_columns = {'appearances': 5, 'goals_conceded': 14, 'clean_sheets': 15}
+        minutes_column = 16
+    else:
+        int_columns = {'appearances': 5, 'goals': 7, 'assists': 8}
+        minutes_column = 17
+
+    cells = pd.DataFrame([[td.text_content() for td in row.xpath('td')] for row in rows])
+    cells = cells.apply(lambda column: column.str.replace(r'\s', '', regex=True))
+
+    season = cells[0]
+    no_slash = ~season.str.contains('/')
+    season = season.where(~no_slash,
+                          (pd.to_numeric(season.where(no_slash, '0')) - 1).astype(str).str[-2:] + '/' + season.str[-2:])
+
+    competitions = [(row.xpath('td[3]//a[@title]/@title') or ['Unknown'])[0] for row in rows]
+
+    player_data = pd.DataFrame({'season': season, 'competition': competitions})
+    player_data['appearances'] = cells[int_columns.pop('appearances')].str.replace('-', '0').astype(int)
+    player_data['PPG'] = cells[6].str.replace('-', '0').str.replace(',', '.').astype(float)
+    for name, column in int_columns.items():
+        player_data[name] = cells[column].str.replace('-', '0').astype(int)
+
+    minutes_played = cells[minutes_column].str.replace('-', '0').str.replace('.', '').str.replace('\'', '')
+    player_data['minutes_played'] = minutes_played.where(minutes_played.str.isdigit(), '0').astype(int)
+
+    return player_data
+
+# (search page parser, player page parser) for fast=True / fast=False
+PARSERS = {
+    True: (parse_search_page_fast, parse_player_page_fast),
+    False: (parse_search_page, parse_player_page),
+}
+
 # Function to scrape player data
-def get_player_data(search_url):
+def get_player_data(search_url, session=None, fast=True):
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/47.0.2526.106 Safari/537.36'}
-        player_data = []
-
-        response = requests.get(search_url, headers=headers)
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        player_url = soup.find("td", class_="hauptlink").find("a")['href']
-        player_url = player_url.replace("profil", "leistungsdatendetails")
-        player_url = player_url + '/saison//verein/0/liga/0/wettbewerb//pos/0/trainer_id/0/plus/1'
-        details_player_url = 'https://www.transfermarkt.com' + player_url
-
-        response = requests.get(details_player_url, headers=headers)
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        position_element = soup.find_all("span", class_="data-header__content")[7]
-        position = position_element.get_text(strip=True) if position_element else "Unknown"
-
-        for row in soup.find("table", class_="items").find("tbody").find_all("tr", class_=["odd", "even"]):
-            columns = row.find_all("td")
-            season = columns[0].get_text(strip=True)
-            season = standardize_season_format(season)  # Standardize season format here
-            competition_link = columns[2].find("a", title=True)
-            competition = competition_link['title'] if competition_link else "Unknown"
-
-            if position == 'Goalkeeper':
-                appearances = int(columns[5].get_text(strip=True).replace("-", "0"))
-                ppg = float(columns[6].get_text(strip=True).replace("-", "0").replace(",", "."))
-                goals_conceded = int(columns[14].get_text(strip=True).replace("-", "0"))
-                clean_sheets = int(columns[15].get_text(strip=True).replace("-", "0"))
-                minutes_played = columns[16].get_text(strip=True).replace('-', '0').replace('.', '').replace('\'', '')
-                minutes_played = int(minutes_played) if minutes_played.isdigit() else 0
-                player_data.append({
-                    'season': season,
-                    'competition': competition,
-                    'appearances': appearances,
-                    'PPG': ppg,
-                    'goals_conceded': goals_conceded,
-                    'clean_sheets': clean_sheets,
-                    'minutes_played': minutes_played
-                })
-            else:
-                appearances = int(columns[5].get_text(strip=True).replace("-", "0"))
-                ppg = float(columns[6].get_text(strip=True).replace("-", "0").replace(",", "."))
-                goals = int(columns[7].get_text(strip=True).replace("-", "0"))
-                assists = int(columns[8].get_text(strip=True).replace("-", "0"))
-                minutes_played = columns[17].get_text(strip=True).replace('-', '0').replace('.', '').replace('\'', '')
-                minutes_played = int(minutes_played) if minutes_played.isdigit() else 0
-                player_data.append({
-                    'season': season,
-                    'competition': competition,
-                    'appearances': appearances,
-                    'PPG': ppg,
-                    'goals': goals,
-                    'assists': assists,
-                    'minutes_played': minutes_played
-                })
-
-        return pd.DataFrame(player_data)
+        session = session or requests
+        parse_search, parse_player = PARSERS[fast]
+
+        response = session.get(search_url, headers=HEADERS)
+        details_player_url = parse_search(response.content)
+
+        response = session.get(details_player_url, headers=HEADERS)
+        return parse_player(response.content)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return pd.DataFrame()
+
+# Function to scrape player data with a pooled httpx.AsyncClient
+async def get_player_data_async(client, search_url, fast=True):
+    try:
+        parse_search, parse_player = PARSERS[fast]
+
+        response = await client.get(search_url, headers=HEADERS)
+        details_player_url = await asyncio.to_thread(parse_search, response.content)
+
+        response = await client.get(details_player_url, headers=HEADERS)
+        return await asyncio.to_thread(parse_player, response.content)
 
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -109,21 +196,48 @@ def from_index_to_name(data, index):
     attempts.append(' '.join(data['short_name'].split()))
     return attempts
 
-def plot_metrics(data, index):
+def plot_metrics(data, index, session=None):
     # Player selection
     name_list = from_index_to_name(data, index)
     i = 0  # Initialize index
     scraped_df_shape = 0  # Initialize shape of scraped_df
 
-    while scraped_df_shape == 0 and i < len(name_list):
-        # Create search URL and get player data
-        search_url = create_search_url(name_list[i])
-        scraped_df = get_player_data(search_url)
-        # Update the shape of scraped_df
-        scraped_df_shape = scraped_df.shape[0]
-        
-        # Increment the index for the next iteration
-        i += 1
+    with requests.Session() if session is None else nullcontext(session) as session:
+        while scraped_df_shape == 0 and i < len(name_list):
+            # Create search URL and get player data
+            search_url = create_search_url(name_list[i])
+            scraped_df = get_player_data(search_url, session)
+            # Update the shape of scraped_df
+            scraped_df_shape = scraped_df.shape[0]
+
+            # Increment the index for the next iteration
+            i += 1
+
+    return aggregate_metrics(scraped_df)
+
+async def plot_metrics_async(data, index, client):
+    '''
+    Same as plot_metrics, but all the name candidates are searched concurrently
+    through the pooled `client`; as in plot_metrics, the first candidate in
+    order with a non empty result wins and the remaining searches are cancelled
+    '''
+    name_list = from_index_to_name(data, index)
+    tasks = [asyncio.create_task(get_player_data_async(client, create_search_url(name)))
+             for name in name_list]
+
+    scraped_df = pd.DataFrame()
+    try:
+        for task in tasks:
+            scraped_df = await task
+            if scraped_df.shape[0] > 0:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return aggregate_metrics(scraped_df)
+
+def aggregate_metrics(scraped_df):
     try:
         # Filter the DataFrame to only include rows where 'minutes_played' >= 45
         scraped_df = scraped_df[scraped_df['minutes_played'] >= 45]
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from player_profiling.params import *
+
+# Bump whenever a cached stage (preprocessing, embedding...) changes its output
+# for the same inputs and params, so that the stage cache of older code is not reused
+STAGE_CACHE_VERSION = 1
+
+
+def hash_data(data) -> str:
+    """
+    Return a sha256 of the content of `data` (DataFrame, Series or array),
+    including its columns and dtypes
+    """
+    sha256 = hashlib.sha256()
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        frame = data.to_frame() if isinstance(data, pd.Series) else data
+        sha256.update(repr((list(frame.columns), [str(dtype) for dtype in frame.dtypes])).encode())
+        sha256.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    else:
+        data = np.ascontiguousarray(data)
+        sha256.update(repr((data.shape, data.dtype.str)).encode())
+        sha256.update(data.tobytes())
+    return sha256.hexdigest()
+
+def stage_key(stage: str, *inputs, func=None, **params) -> str:
+    """
+    Return the cache key of `stage` run on `inputs` with `params`, salted with
+    STAGE_CACHE_VERSION and the qualified name of the stage `func`
+    """
+    sha256 = hashlib.sha256(f"{stage}:{STAGE_CACHE_VERSION}".encode())
+    if func is not None:
+        sha256.update(f"{func.__module__}.{func.__qualname__}".encode())
+    for data in inputs:
+        sha256.update(hash_data(data).encode())
+    sha256.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    return sha256.hexdigest()
+
+def run_stage(stage: str, func, *inputs, cache_path: str = STAGE_CACHE_PATH, **params):
+    """
+    Return func(*inputs, **params), loaded from `cache_path` if the stage already
+    ran on the same inputs with the same params, stored there otherwise
+    """
+    key = stage_key(stage, *inputs, func=func, **params)
+    path = Path(cache_path).joinpath(f"{stage}-{key}.joblib")
+
+    if path.is_file():
+        print(f"✅ {stage} loaded from stage cache ({key[:12]})")
+        return joblib.load(path)
+
+    result = func(*inputs, **params)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}-{time.time_ns()}.tmp")
+    joblib.dump(result, tmp_path)
+    os.replace(tmp_path, path)
+
+    return result
+
+def _uploads_path(cache_path: str) -> Path:
+    return Path(cache_path).joinpath("uploads.json")
+
+def _read_uploads(cache_path: str) -> dict:
+    path = _uploads_path(cache_path)
+    return json.loads(path.read_text()) if path.is_file() else {}
+
+def _write_uploads(uploads: dict, cache_path: str) -> None:
+    path = _uploads_path(cache_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(uploads, indent=2))
+    os.replace(tmp_path, path)
+
+def is_uploaded(table: str, key: str, version: str, cache_path: str = STAGE_CACHE_PATH) -> bool:
+    """
+    Return True if `table` was last written by fit() with content `key` and was
+    not written since, i.e. its storage version (see storage.table_version) is
+    still `version`
+    """
+    if version is None:
+        return False
+    return _read_uploads(cache_path).get(table) == {"key": key, "version": version}
+
+def mark_uploaded(table: str, key: str, version: str, cache_path: str = STAGE_CACHE_PATH) -> None:
+    """
+    Record that `table` now holds content `key`, at storage version `version`
+    """
+    uploads = _read_uploads(cache_path)
+    uploads[table] = {"key": key, "version": version}
+    _write_uploads(uploads, cache_path)
+
+def forget_uploads(*tables: str, cache_path: str = STAGE_CACHE_PATH) -> None:
+    """
+    Forget the content of `tables`, to be called by anything else writing them
+    """
+    uploads = _read_uploads(cache_path)
+    for table in tables:
+        uploads.pop(table, None)
+    _write_uploads(uploads, cache_path)
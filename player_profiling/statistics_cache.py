@@ -0,0 +1,108 @@
+import asyncio
+import pickle
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from player_profiling.params import *
+from player_profiling.scraping_utils import plot_metrics, plot_metrics_async
+
+
+@contextmanager
+def connect_statistics_cache(cache_path: str = STATS_CACHE_PATH):
+    """
+    Open the SQLite statistics cache at `cache_path` as one transaction,
+    creating the table if needed. Entries are keyed by the idx of the players
+    table, which stays the same when the rows are reordered or reloaded.
+    WAL mode lets every uvicorn worker read while another one writes
+    """
+    conn = sqlite3.connect(cache_path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS player_statistics (
+                idx INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                payload BLOB NOT NULL
+            )
+        """)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def load_statistics(idx: int, ttl: int = STATS_CACHE_TTL, cache_path: str = STATS_CACHE_PATH) -> dict:
+    """
+    Return the cached statistics of player `idx`, or None if missing or older than `ttl` seconds
+    """
+    now = time.time()
+    with connect_statistics_cache(cache_path) as conn:
+        row = conn.execute(
+            "SELECT payload FROM player_statistics WHERE idx = ? AND created_at >= ?",
+            (int(idx), now - ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE player_statistics SET accessed_at = ? WHERE idx = ?", (now, int(idx)))
+
+    return pickle.loads(row[0])
+
+def save_statistics(
+        idx: int,
+        statistics: dict,
+        ttl: int = STATS_CACHE_TTL,
+        max_entries: int = STATS_CACHE_MAX_ENTRIES,
+        cache_path: str = STATS_CACHE_PATH
+    ) -> None:
+    """
+    - Store the statistics of player `idx`
+    - Drop expired entries, then the least recently used ones above `max_entries`
+    """
+    now = time.time()
+    with connect_statistics_cache(cache_path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO player_statistics (idx, created_at, accessed_at, payload) VALUES (?, ?, ?, ?)",
+            (int(idx), now, now, pickle.dumps(statistics))
+        )
+        conn.execute("DELETE FROM player_statistics WHERE created_at < ?", (now - ttl,))
+        conn.execute("""
+            DELETE FROM player_statistics WHERE idx IN (
+                SELECT idx FROM player_statistics ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (max_entries,))
+
+def get_statistics_with_cache(data, index) -> dict:
+    """
+    Retrieve the statistics of the player at row `index` of `data` from the
+    cache (keyed by its idx) if fresh, scrape them from Transfermarkt otherwise
+    and store them for future use
+    """
+    idx = int(data['idx'].iloc[int(index)])
+    statistics = load_statistics(idx)
+    if statistics is not None:
+        return statistics
+
+    statistics = plot_metrics(data, index)
+
+    # Only cache successful scrapes, plot_metrics returns an empty DataFrame on failure
+    if isinstance(statistics, dict) and not statistics['aggregated_data'].empty:
+        save_statistics(idx, statistics)
+
+    return statistics
+
+async def get_statistics_with_cache_async(data, index, client) -> dict:
+    """
+    Same as get_statistics_with_cache, scraping through the pooled httpx `client`
+    """
+    idx = int(data['idx'].iloc[int(index)])
+    statistics = await asyncio.to_thread(load_statistics, idx)
+    if statistics is not None:
+        return statistics
+
+    statistics = await plot_metrics_async(data, index, client)
+
+    if isinstance(statistics, dict) and not statistics['aggregated_data'].empty:
+        await asyncio.to_thread(save_statistics, idx, statistics)
+
+    return statistics
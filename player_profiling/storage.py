@@ -0,0 +1,170 @@
+import glob
+import os
+import re
+import shutil
+import time
+
+import pandas as pd
+
+from player_profiling.params import *
+
+# DATA_TARGET selects where the players tables live:
+# - "bigquery": the BigQuery dataset BQ_DATASET of GCP_PROJECT
+# - "duckdb": one directory of Parquet files per table under DUCKDB_PATH, queried
+#   with DuckDB (projections and filters are pushed down to the Parquet scan)
+
+# `project.dataset.table` (BigQuery table path) after FROM / JOIN
+TABLE_PATH = re.compile(r"\b(FROM|JOIN)\s+`?[\w-]+\.[\w-]+\.(\w+)`?", re.IGNORECASE)
+
+
+def query_table(gcp_project: str, query: str) -> pd.DataFrame:
+    """
+    Return the result of the BigQuery SQL `query` from the DATA_TARGET storage
+    """
+    if DATA_TARGET == "duckdb":
+        return duckdb_query(query)
+
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=gcp_project)
+    query_job = client.query(query)
+    result = query_job.result()
+    return result.to_dataframe()
+
+def write_table(data: pd.DataFrame, gcp_project: str, bq_dataset: str, table: str, truncate: bool) -> None:
+    """
+    Write `data` to `table` of the DATA_TARGET storage, replacing its rows if
+    `truncate` is True, appending them otherwise
+    """
+    if DATA_TARGET == "duckdb":
+        return duckdb_write(data, table, truncate)
+
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=gcp_project)
+    write_mode = "WRITE_TRUNCATE" if truncate else "WRITE_APPEND"
+    job_config = bigquery.LoadJobConfig(write_disposition=write_mode)
+    job = client.load_table_from_dataframe(data, f"{gcp_project}.{bq_dataset}.{table}", job_config=job_config)
+    job.result()  # wait for the job to complete
+
+def delete_rows(gcp_project: str, bq_dataset: str, table: str, idx: list) -> int:
+    """
+    Delete the rows of `table` whose idx is in `idx` from the DATA_TARGET
+    storage, return the number of deleted rows
+    """
+    idx = [int(i) for i in idx]
+    if DATA_TARGET == "duckdb":
+        return duckdb_delete(table, idx)
+
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=gcp_project)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("idx", "INT64", idx)]
+    )
+    job = client.query(f"DELETE FROM `{gcp_project}.{bq_dataset}.{table}` WHERE idx IN UNNEST(@idx)",
+                       job_config=job_config)
+    job.result()
+    return job.num_dml_affected_rows
+
+def table_version(gcp_project: str, bq_dataset: str, table: str) -> str:
+    """
+    Return the version of `table` in the DATA_TARGET storage: its last
+    modification time in ms, which changes whenever it is written
+    """
+    if DATA_TARGET == "duckdb":
+        files = glob.glob(table_files(table))
+        return str(max(os.stat(file).st_mtime_ns for file in files) // 1_000_000) if files else None
+
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=gcp_project)
+    return str(int(client.get_table(f"{gcp_project}.{bq_dataset}.{table}").modified.timestamp() * 1000))
+
+
+def table_directory(table: str) -> str:
+    return os.path.join(DUCKDB_PATH, table)
+
+def table_files(table: str) -> str:
+    return os.path.join(table_directory(table), "*.parquet")
+
+def duckdb_connect():
+    """
+    Return an in-memory DuckDB connection with a view per table of DUCKDB_PATH
+    """
+    import duckdb
+
+    conn = duckdb.connect()
+    for directory in sorted(glob.glob(os.path.join(DUCKDB_PATH, "*"))):
+        table = os.path.basename(directory)
+        # skip the directories being swapped in / out by replace_directory
+        if "." not in table and glob.glob(table_files(table)):
+            conn.execute(f"""CREATE VIEW "{table}" AS
+                             SELECT * FROM read_parquet('{table_files(table)}', union_by_name = true)""")
+    return conn
+
+def duckdb_query(query: str) -> pd.DataFrame:
+    """
+    Run a BigQuery SQL `query` on the local tables, `project.dataset.table`
+    paths being read as the local `table`
+    """
+    conn = duckdb_connect()
+    try:
+        return conn.execute(TABLE_PATH.sub(r'\1 "\2"', query)).df()
+    finally:
+        conn.close()
+
+def duckdb_write(data: pd.DataFrame, table: str, truncate: bool) -> None:
+    """
+    Append `data` to the local `table` as a new Parquet file, or swap in a
+    new directory holding only `data` if `truncate` is True
+    """
+    part = f"part-{time.time_ns()}-{os.getpid()}.parquet"
+
+    if not truncate:
+        os.makedirs(table_directory(table), exist_ok=True)
+        tmp_path = os.path.join(table_directory(table), part + ".tmp")
+        data.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(table_directory(table), part))
+        return None
+
+    os.makedirs(DUCKDB_PATH, exist_ok=True)
+    new_directory = f"{table_directory(table)}.{os.getpid()}.new"
+    os.makedirs(new_directory)
+    data.to_parquet(os.path.join(new_directory, part), index=False)
+    replace_directory(new_directory, table)
+
+def duckdb_delete(table: str, idx: list) -> int:
+    """
+    Rewrite the local `table` without the rows whose idx is in `idx`
+    """
+    if not glob.glob(table_files(table)):
+        return 0
+
+    conn = duckdb_connect()
+    try:
+        conn.execute("CREATE TEMP TABLE deleted_idx AS SELECT UNNEST(?::BIGINT[]) AS idx", [idx])
+        deleted = conn.execute(f"""SELECT COUNT(*) FROM "{table}"
+                                   WHERE idx IN (SELECT idx FROM deleted_idx)""").fetchone()[0]
+        if deleted == 0:
+            return 0
+
+        new_directory = f"{table_directory(table)}.{os.getpid()}.new"
+        os.makedirs(new_directory)
+        conn.execute(f"""COPY (SELECT * FROM "{table}" WHERE idx NOT IN (SELECT idx FROM deleted_idx))
+                         TO '{os.path.join(new_directory, f"part-{time.time_ns()}.parquet")}' (FORMAT parquet)""")
+    finally:
+        conn.close()
+
+    replace_directory(new_directory, table)
+    return deleted
+
+def replace_directory(new_directory: str, table: str) -> None:
+    """
+    Swap `new_directory` in as the directory of `table`
+    """
+    old_directory = f"{table_directory(table)}.{os.getpid()}.old"
+    if os.path.isdir(table_directory(table)):
+        os.replace(table_directory(table), old_directory)
+    os.replace(new_directory, table_directory(table))
+    shutil.rmtree(old_directory, ignore_errors=True)
@@ -2,106 +2,209 @@ import pandas as pd
 import numpy as np
 import requests
 from io import BytesIO
-from IPython.display import display, Image
-from PIL import Image as PILImage
 from unidecode import unidecode
 
 
-def ultimate_filtering (raw_data, compressed_data, continent = None, experience = None,
-                        wage_range = None, value_range= None, league_level = None):
-    if continent:
-        raw_data = raw_data[raw_data['Continent']== continent]
+# Columns returned for every player by the API
+PLAYER_COLUMNS = ['short_name', 'player_url', 'player_positions', 'age', 'height_cm',
+                  'league_name', 'club_name', 'nationality_name', 'preferred_foot', 'player_face_url', 'idx']
 
-    if experience:
-        raw_data = raw_data[raw_data['experience'] == experience]
+# Filter argument -> column of raw_data it applies to
+FILTER_COLUMNS = {
+    'continent': 'Continent',
+    'experience': 'experience',
+    'wage_range': 'wage_range',
+    'value_range': 'value_range',
+    'league_level': 'league_level_bin',
+}
 
-    if wage_range:
-        raw_data = raw_data[raw_data['wage_range'] == wage_range]
+def build_filter_index(raw_data):
+    '''
+    raw_data as a Dataframe
+    function that builds a boolean bitmap per value of every filter column,
+    plus the goalkeeper bitmap, to be built once and reused by filter_mask
+    '''
+    filter_index = {}
+    for column in FILTER_COLUMNS.values():
+        values = raw_data[column].values
+        filter_index[column] = {value: values == value for value in pd.unique(values) if pd.notna(value)}
 
-    if value_range:
-        raw_data = raw_data[raw_data['value_range'] == value_range]
+    filter_index['goalkeeper'] = (raw_data['player_positions'] == 'GK').values
+    return filter_index
 
-    if league_level:
-        raw_data = raw_data[raw_data['league_level_bin'] == league_level]
+def filter_mask(filter_index, continent = None, experience = None,
+                wage_range = None, value_range= None, league_level = None):
+    '''
+    function that intersects the bitmaps of the requested filters,
+    returns a boolean array over the rows of raw_data
+    '''
+    filters = {'continent': continent, 'experience': experience, 'wage_range': wage_range,
+               'value_range': value_range, 'league_level': league_level}
+
+    mask = np.ones(len(filter_index['goalkeeper']), dtype=bool)
+    for name, value in filters.items():
+        if value:
+            bitmap = filter_index[FILTER_COLUMNS[name]].get(value)
+            if bitmap is None:
+                return np.zeros_like(mask)
+            mask &= bitmap
+    return mask
+
+def ultimate_filtering (raw_data, compressed_data = None, continent = None, experience = None,
+                        wage_range = None, value_range= None, league_level = None,
+                        filter_index = None):
+    '''
+    compressed_data is unused (only raw_data is filtered and returned), kept so
+    that positional calls ultimate_filtering(data, compressed, continent) still work
+    '''
+    if filter_index is None:
+        filter_index = build_filter_index(raw_data)
 
-    compressed_data = compressed_data[compressed_data.index.isin(raw_data.index)]
+    mask = filter_mask(filter_index, continent = continent, experience = experience,
+                       wage_range = wage_range, value_range= value_range,
+                       league_level = league_level)
 
-    return raw_data #, compressed_data
+    return raw_data[mask]
 
-def find_closest_players(player_index, raw_data, compressed_data, continent = None, experience = None,
-                        wage_range = None, value_range= None, league_level = None):
+def build_cluster_index(raw_data, compressed_data):
     '''
-    player index, raw_data as a Dataframe, compressed_data as a numpy array
-    function that prints out the 5 closest player to the selected one
+    raw_data as a Dataframe with a label column, compressed_data as the tsne Dataframe
+    function that builds one KDTree per cluster label over the tsne coordinates,
+    to be built once and reused by find_closest_players
     '''
-    # Step 0: Gives player name index based on user input
-    #player_index = finding_player_index(player_name,raw_data)
-    # Step 1: Choose a Player
-    player_of_interest_index = int(player_index)  # Replace with the index of the player you're interested in
+    from sklearn.neighbors import KDTree
 
-    # Step 2: Get the Cluster Assignment of the Player of Interest
-    cluster_of_interest = raw_data.loc[player_of_interest_index, 'label']
+    coordinates = pd.DataFrame(compressed_data).drop(columns=['idx']).values
+    labels = raw_data['label'].values
 
-    # Step 3: Filter Data for the Same Cluster
-    cluster_indices = np.where(raw_data['label'] == cluster_of_interest)[0]
+    clusters = {}
+    for label in np.unique(labels):
+        positions = np.flatnonzero(labels == label)
+        clusters[label] = (KDTree(coordinates[positions]), positions)
 
-    compressed_data = pd.DataFrame(compressed_data).drop(columns=['idx'])
-    # Step 4: Calculate Distances
-    distances = np.linalg.norm(compressed_data.iloc[cluster_indices].values -
-                               compressed_data.iloc[player_of_interest_index].values, axis=1)
+    return {'coordinates': coordinates,
+            'clusters': clusters}
 
-    # Step 5: Identify the 5 Closest Players
-    closest_player_indices = cluster_indices[np.argsort(distances)]
-    closest_players = raw_data.iloc[closest_player_indices]
+def find_closest_players(player_index, raw_data, compressed_data, continent = None, experience = None,
+                        wage_range = None, value_range= None, league_level = None,
+                        cluster_index = None, filter_index = None, n_players = 5):
+    '''
+    player index, raw_data as a Dataframe, compressed_data as the tsne Dataframe,
+    cluster_index and filter_index as returned by build_cluster_index and
+    build_filter_index (built on the fly if None)
+    function that returns the n_players closest players to the selected one
+    '''
+    if cluster_index is None:
+        cluster_index = build_cluster_index(raw_data, compressed_data)
+    if filter_index is None:
+        filter_index = build_filter_index(raw_data)
 
-    if closest_players.iloc[player_of_interest_index]['player_positions'] == 'GK':
-        closest_players = closest_players[closest_players['player_positions']== 'GK']
+    # Step 1: Choose a Player
+    player_of_interest_index = int(player_index)
+    player_of_interest = raw_data.iloc[player_of_interest_index]
+
+    # Step 2: Get the tree of the cluster of the Player of Interest
+    tree, cluster_positions = cluster_index['clusters'][player_of_interest['label']]
+    coordinates = cluster_index['coordinates']
+    point = coordinates[[player_of_interest_index]]
+
+    # Step 3: Intersect the filters before any distance is computed
+    allowed = filter_mask(filter_index, continent = continent, experience = experience,
+                          wage_range = wage_range, value_range= value_range,
+                          league_level = league_level)
+    if player_of_interest['player_positions'] == 'GK':
+        allowed &= filter_index['goalkeeper']
     else:
-        closest_players = closest_players[closest_players['player_positions']!= 'GK']
+        allowed &= ~filter_index['goalkeeper']
+    allowed[player_of_interest_index] = False
 
+    candidates = cluster_positions[allowed[cluster_positions]]
 
+    # Step 4: Score the candidates. A narrow filter leaves few candidates that are
+    # scored directly, otherwise query the tree and widen k until enough
+    # players pass the filters or the whole cluster has been visited
+    if len(candidates) <= len(cluster_positions) // 2:
+        distances = np.linalg.norm(coordinates[candidates] - point, axis=1)
+        closest_positions = candidates[np.argsort(distances, kind='stable')[:n_players]]
+    else:
+        k = min(2 * (n_players + 1), len(cluster_positions))
+        while True:
+            _, nearest = tree.query(point, k=k)
+            closest_positions = cluster_positions[nearest[0]]
+            closest_positions = closest_positions[allowed[closest_positions]][:n_players]
 
-    data = ultimate_filtering (closest_players, compressed_data, continent = continent, experience = experience,
-                        wage_range = wage_range, value_range= value_range,
-                        league_level = league_level)
+            if len(closest_positions) >= n_players or k == len(cluster_positions):
+                break
+            k = min(4 * k, len(cluster_positions))
 
+    data = raw_data.iloc[closest_positions]
 
+    return data[PLAYER_COLUMNS]
 
 
+def normalize_name(name):
+    return unidecode(name).upper()
 
-    data = data.drop(int(player_index), errors ='ignore')
+def name_ngrams(name, n = 3):
+    return {name[i:i + n] for i in range(len(name) - n + 1)}
 
-    #print(f"The closest player to the player of interest is:\n{closest_players['short_name']}")
+def build_name_index(data, n = 3):
+    '''
+    data as a Dataframe
+    function that normalizes every short_name and long_name once and builds
+    an n-gram index (n-gram -> sorted row positions) over both of them,
+    to be built once and reused by find_player_match
+    '''
+    short_names = [normalize_name(sn) for sn in data['short_name']]
+    long_names = [normalize_name(ln) for ln in data['long_name']]
 
-    return data[['short_name', 'player_url', 'player_positions', 'age', 'height_cm',
-                 'league_name', 'club_name', 'nationality_name', 'preferred_foot', 'player_face_url', 'idx']].head(5)
+    ngrams = {}
+    for position, (snc, lnc) in enumerate(zip(short_names, long_names)):
+        for gram in name_ngrams(snc, n) | name_ngrams(lnc, n):
+            ngrams.setdefault(gram, []).append(position)
 
+    return {'short_name': np.array(short_names, dtype=str),
+            'long_name': np.array(long_names, dtype=str),
+            'ngrams': {gram: np.array(positions) for gram, positions in ngrams.items()},
+            'n': n}
 
-def find_player_match(name, data):
-    matched_names = []
-    normalized_name = unidecode(name).upper()
+def find_player_match(name, data, name_index = None):
+    '''
+    returns the row positions of the players whose short_name or long_name
+    contains name, ignoring accents and case
+    '''
+    if name_index is None:
+        name_index = build_name_index(data)
+
+    normalized_name = normalize_name(name)
+
+    # Candidates are the rows holding every n-gram of the name, names shorter
+    # than n are checked against all rows
+    grams = name_ngrams(normalized_name, name_index['n'])
+    if grams:
+        postings = sorted((name_index['ngrams'].get(gram, np.array([], dtype=int)) for gram in grams), key=len)
+        candidates = postings[0]
+        for positions in postings[1:]:
+            candidates = np.intersect1d(candidates, positions, assume_unique=True)
+    else:
+        candidates = np.arange(len(name_index['short_name']))
 
-    for sn, ln in zip(data['short_name'], data['long_name']):
-        snc = unidecode(sn).upper()
-        lnc = unidecode(ln).upper()
-        if normalized_name in snc:
-            matched_names.append(sn)
-        elif normalized_name in lnc:
-            matched_names.append(sn)
+    matched = ((np.char.find(name_index['short_name'][candidates], normalized_name) >= 0) |
+               (np.char.find(name_index['long_name'][candidates], normalized_name) >= 0))
 
-    return matched_names
+    return candidates[matched]
 
 
-def find_player_index(name, data):
-    names = find_player_match (name, data)
+def find_player_index(name, data, name_index = None):
+    positions = find_player_match (name, data, name_index)
 
-    if len(names) == 0:
+    if len(positions) == 0:
         return f'{name} not found'
 
+    players_indexes = data.iloc[positions]
+    return players_indexes[PLAYER_COLUMNS]
+
 #    elif len(names) == 1:
-    players_indexes = data[data['short_name'].isin(names)]
-    return players_indexes[['short_name', 'player_url', 'player_positions', 'age', 'height_cm',
-                            'league_name', 'club_name', 'nationality_name', 'preferred_foot', 'player_face_url', 'idx']]
 
 #    elif len(names) <= 5:
 #        print(f'Found {len(names)} players for your search')
@@ -125,6 +228,8 @@ def find_player_index(name, data):
 #            print('Please retry, number  is not in the list')
 
 def show_face(player_id, data):
+    from IPython.display import display, Image
+    from PIL import Image as PILImage
 
     face = data.iloc[player_id]['player_face_url']
     response = requests.get(face)